@@ -0,0 +1,152 @@
+"""Tests for vprune.py, run against test-tcx-file.tcx.  Run with: python -m pytest -q"""
+
+import json, os, re, shutil, struct
+
+import numpy as np
+import pytest
+from lxml import etree
+
+import vprune
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ns1 = vprune.ns1
+
+
+@pytest.fixture(autouse=True)
+def fresh_options():
+	#main() keeps the options in module globals, as they were set for the whole process; put them back after each test
+	saved = dict(vars(vprune))
+	yield
+	for name, value in saved.items():
+		setattr(vprune, name, value)
+
+@pytest.fixture
+def route(tmp_path, monkeypatch):
+	#A copy of the test file in an empty directory, which is also the current directory (output files go there)
+	shutil.copy(os.path.join(HERE, 'test-tcx-file.tcx'), str(tmp_path / 'route.tcx'))
+	monkeypatch.chdir(tmp_path)
+	return tmp_path
+
+def output_files(directory, extension):
+	return sorted(name for name in os.listdir(str(directory)) if name.startswith('vp_') and name.endswith(extension))
+
+def parse(path):
+	return etree.parse(str(path)).getroot()
+
+def trackpoint_count(path):
+	return len(parse(path).findall('.//{%s}Trackpoint'%ns1))
+
+
+@pytest.mark.parametrize('strategy', ['random', 'vw'])
+def test_exact_point_budget(route, strategy):
+	vprune.main(['--maxpoints', '300', '--strategy', strategy, 'route.tcx'])
+	files = output_files(route, '.tcx')
+	assert len(files) > 1
+	for name in files:
+		assert trackpoint_count(route / name) == 300, name
+
+def test_exact_point_budget_two_tracks(route):
+	#The same route, cut into two Tracks halfway: the budget is still per file, not per Track
+	text = (route / 'route.tcx').read_text()
+	starts = [m.start() for m in re.finditer('<Trackpoint>', text)]
+	middle = starts[len(starts) // 2]
+	(route / 'route.tcx').write_text(text[:middle] + '</Track>\n      <Track>\n' + text[middle:])
+	vprune.main(['--maxpoints', '250', '--strategy', 'vw', 'route.tcx'])
+	for name in output_files(route, '.tcx'):
+		assert trackpoint_count(route / name) == 250, name
+
+
+def test_fit_crc(route):
+	vprune.main(['--format', 'fit', 'route.tcx'])
+	files = output_files(route, '.fit')
+	assert files
+	for name in files:
+		data = (route / name).read_bytes()
+		header_size, protocol, profile, data_size, signature = struct.unpack('<BBHI4s', data[:12])
+		assert (header_size, signature) == (14, b'.FIT')
+		assert len(data) == header_size + data_size + 2
+		assert struct.unpack('<H', data[12:14])[0] == vprune.fit_crc(0, data[:12])
+		assert struct.unpack('<H', data[-2:])[0] == vprune.fit_crc(0, data[:-2])
+		assert vprune.fit_crc(0, data) == 0
+
+
+def test_gpx_round_trip(route):
+	vprune.main(['--maxpoints', '300', '--seed', '7', 'route.tcx'])
+	vprune.main(['--maxpoints', '300', '--seed', '7', '--format', 'gpx', 'route.tcx'])
+	tcx_files = output_files(route, '.tcx')
+	gpx_files = output_files(route, '.gpx')
+	assert len(tcx_files) == len(gpx_files) > 0
+	for tcx_name, gpx_name in zip(tcx_files, gpx_files):
+		tcx = parse(route / tcx_name)
+		gpx = vprune.read_gpx(str(route / gpx_name)).getroot()
+		expected = vprune.track_arrays(tcx.find('.//{%s}Track'%ns1))
+		got = vprune.track_arrays(gpx.find('.//{%s}Track'%ns1))
+		assert np.allclose(got['lat'], expected['lat'])
+		assert np.allclose(got['lon'], expected['lon'])
+		assert np.array_equal(got['seconds'], expected['seconds'])
+		assert len(gpx.findall('.//{%s}CoursePoint'%ns1)) == len(tcx.findall('.//{%s}CoursePoint'%ns1))
+
+
+def test_split_plan_limits(route):
+	index = vprune.route_index(parse(route / 'route.tcx'))
+	total = len(index['turns'])
+	maxturns, overlap_num, max_km = 80, 4, 40
+	plan = vprune.limit_split_plan(index, {'km': max_km}, maxturns, overlap_num)
+	assert len(plan) > 1
+	assert plan[0][0] == 0 and plan[-1][1] == total
+	for (start, end), (next_start, next_end) in zip(plan, plan[1:]):
+		assert start < next_start < end #each file runs on into the next one
+	for start, end in plan:
+		first, last = max(start, 1) - 1, end - 1
+		assert end - start <= maxturns
+		#Within the limit, unless a single gap between two turns is already longer
+		assert index['km'][last] - index['km'][first] <= max_km or end - start <= 1
+
+
+def delta_written(capsys, argv):
+	vprune.main(argv)
+	found = re.search(r'Delta: (\d+) of (\d+) files written', capsys.readouterr().out)
+	assert found
+	return int(found.group(1)), int(found.group(2))
+
+def test_delta(route, capsys):
+	argv = ['--delta', '--maxpoints', '300', 'route.tcx']
+	written, files = delta_written(capsys, argv)
+	assert written == files > 2
+	assert delta_written(capsys, argv) == (0, files)
+	#Move one Trackpoint in the middle of the route: only the file(s) holding it are written again
+	text = (route / 'route.tcx').read_text()
+	latitudes = list(re.finditer(r'<LatitudeDegrees>([^<]*)</LatitudeDegrees>', text))
+	middle = latitudes[len(latitudes) // 2]
+	moved = '<LatitudeDegrees>%.7f</LatitudeDegrees>' % (float(middle.group(1)) + 0.0001)
+	(route / 'route.tcx').write_text(text[:middle.start()] + moved + text[middle.end():])
+	written, again = delta_written(capsys, argv)
+	assert again == files
+	assert 1 <= written <= 2
+
+
+def write_rules(route, entries):
+	(route / 'rules.json').write_text(json.dumps(entries))
+	return str(route / 'rules.json')
+
+def test_rules_file(route):
+	names = vprune.load_rules_file(write_rules(route, [
+		{"name": "t_nodanger", "path": "ns1:CoursePoint[ns1:PointType='Danger']", "action": "remove"},
+		{"name": "t_road", "path": "ns1:CoursePoint/ns1:Name", "action": "replace", "pattern": "Road", "replacement": "Rd"}]))
+	assert names == ['t_nodanger', 't_road']
+
+def test_rules_file_bad_action(route):
+	with pytest.raises(ValueError):
+		vprune.load_rules_file(write_rules(route, [{"name": "t_text", "path": "ns1:CoursePoint/ns1:Name", "action": "text"}]))
+
+def test_rules_file_replace_without_pattern(route):
+	with pytest.raises(KeyError):
+		vprune.load_rules_file(write_rules(route, [{"name": "t_nopattern", "path": "ns1:CoursePoint/ns1:Name", "action": "replace"}]))
+
+def test_rules_file_error_stops_the_run(route, capsys):
+	rulesfile = write_rules(route, [{"name": "t_text", "path": "ns1:CoursePoint/ns1:Name", "action": "text"}])
+	with pytest.raises(SystemExit):
+		vprune.main(['--rules', rulesfile, 'route.tcx'])
+	out = capsys.readouterr().out
+	assert '*******ERROR**********' in out and 'could not load --rules file' in out
+	assert not output_files(route, '.tcx')
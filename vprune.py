@@ -22,7 +22,13 @@ Trackpoints are the most numerous. They are used to draw the detailed route. The
 
 With too few Trackpoints the route becomes "jaggy" and doesn't follow roads or trails exactly.  With too many Trackpoints the file may be too large to upload to your GPS device.
 
-In remove Trackpoints, vprune simply deletes points randomly. It does not attempt to use an optimizing algorithm. This seems to work well enough with RideWithGPS style .tcx files--as long as you don't remove too many points.
+In remove Trackpoints, vprune by default simply deletes points randomly. It does not attempt to use an optimizing algorithm. This seems to work well enough with RideWithGPS style .tcx files--as long as you don't remove too many points.  Each output file gets exactly the number of Trackpoints asked for, and the random choice is repeatable: the same file and options (including --seed) always give the same output.
+
+With --strategy vw vprune uses the Visvalingam-Whyatt algorithm instead: it repeatedly removes the Trackpoint that makes the least difference to the shape of the route, until exactly --maxpoints Trackpoints remain in each output file.  Use this when your device has a hard limit on the number of points.
+
+With --strategy spacing vprune keeps Trackpoints by distance along the route: a point is kept once --min-gap meters have passed since the last one kept, and kept points are never more than --max-gap meters apart. This avoids long straight stretches with hardly any points.
+
+With --turn-radius, vprune spends more of each file's Trackpoints close to the turns, where turn-by-turn navigation needs the route to be accurate, and fewer on the stretches between turns.  For example --turn-radius 150 --turn-share 60 spends 60% of the Trackpoints that can be removed within 150 meters of a turn.
 
 Every CoursePoint (ie, point with turn-by-turn direction) must have an corresponding Trackpoint. So Trackpoints that correspond to spots with a turn-by-turn direction are never removed.
 
@@ -36,6 +42,8 @@ When the file is split into several files, each file overlaps the other by four
 
 By default, output files are named vp_INPUTFILE (if one outputfile) or vp_1_INPUTFILE, vp_2_INPUTFILE, etc, if more than one. You can change the file prefix as desired.
 
+If the .tcx file holds several Courses (a multi-day tour exported as one file, say), each Course is pruned and split on its own, several at once on machines with more than one processor (--jobs sets how many). Files for the second Course are named vp_1_c2_INPUTFILE, vp_2_c2_INPUTFILE, and so on.
+
 VPrune can also, optionally, clean CoursePoint Notes and/or Generic CoursePoints. This reduces file size, and these features may cause problems with some GPS devices or simply be useless (never displayed) in others.
 
 VPrune is specifically designed process .tcx files created with RideWithGPS and create .tcx files that will work with Lezyne GPS devices, which have problems when .tcx files are too large or have too many turns. It may be useful for .tcx files created by other sources and for other GPS devices as well.
@@ -49,10 +57,11 @@ VPrune will run on most any platform that Python can run on. That includes Windo
     
 	pip install docopt
 	pip install lxml==4.4.1
+	pip install numpy
 	pip install PYSimpleGUI==4.2.0
 	pip install PYSimpleGUIWeb==0.28.1
 
-	The first two libraries are needed for all versions.  The second two are needed to run the windowed GUI and web GUI versions.
+	The first three libraries are needed for all versions.  The second two are needed to run the windowed GUI and web GUI versions.
 	OR (shorter) just use: pip install -r requirements.txt
 
 3. Depending on your operating system, you may be able to double-click vprune.py to run it (windows mode).  Otherwise at the command line or console type:
@@ -139,6 +148,7 @@ Step by step instructions:
      
         - VPrune looks in the directory where it is started for the .tcx file. If you start with vprune.py and the sample.tcx file in the same directory it is much easier
         - Unfortunately the "Browse" button does not work in the Web GUI version (yet!), so you cannot select the desired file from a list, but must manually type the name.     
+        - The processed files are saved together in one zip file (eg vp_sample.zip) in the same directory as the .tcx file
 
      
 COMMAND LINE USAGE EXAMPLES:
@@ -147,15 +157,39 @@ COMMAND LINE USAGE EXAMPLES:
   vprune --maxturns 100 --maxpoints 1000 --cleancourse --nocleannotes routefile.tcx
   vprune --maxturns 60 --maxpoints 400 --prefix new_ routefile.tcx 
   vprune --split 6 --maxpoints 750 routefile.tcx                                 
+  vprune --maxpoints 250,500,1500 routefile.tcx               - three sets of files in one go: vp_250_1_routefile.tcx, vp_500_1_routefile.tcx, ...
+  vprune --max-km 80 --max-trackpoints-per-file 3000 routefile.tcx
+  vprune --split 5 --balance trackpoints routefile.tcx
   vprune --percent 50 routefile.tcx   
+  vprune --strategy vw --maxpoints 250 routefile.tcx
+  vprune --strategy spacing --min-gap 50 --max-gap 300 routefile.tcx
+  vprune --strategy vw --turn-radius 150 --turn-share 60 routefile.tcx
+  vprune bench-strategies --maxpoints 300 routefile.tcx    - compare every pruning strategy on this file (no output files are kept)
+  vprune generate-tcx --trackpoints 500000 big.tcx         - write a made-up (but realistic) route of any size, for testing
+  vprune benchmark --sizes 10000,100000,1000000 --baseline bench.json   - time each stage on made-up routes of these sizes
+  vprune --profile routefile.tcx                            - show where the time went, by stage and by output file
+  vprune --profile --cprofile out.prof routefile.tcx        - as --profile, and also save a cProfile dump to out.prof
+  vprune --report report.json routefile.tcx                 - also save the results, file by file, as JSON
+  vprune --memtrace routefile.tcx                           - show how much memory each stage used
+  vprune --rules myrules.json routefile.tcx                 - also apply your own cleanup rules to each Course
+  vprune --format fit routefile.tcx                         - write FIT course files (vp_1_routefile.fit, ...) instead of .tcx
+  vprune --maxpoints 400 routefile.gpx                      - GPX files work too: waypoints become CoursePoints, output is .gpx
+  vprune --compact --decimals 5 routefile.tcx               - smaller output files: no indenting, rounded positions & distances
+  vprune --fidelity --maxpoints 250 routefile.tcx           - how far from the route does pruning this hard leave each file?
+  vprune --dry-run --maxturns 60 routefile.tcx              - just show the split plan & output file sizes, at once, writing nothing
+  vprune --out-tar - - < routefile.tcx | gzip > route.tar.gz - read the .tcx from stdin, write the output files to stdout as a tar
+  vprune --delta --maxpoints 400 routefile.tcx              - after a new version of the route: rewrite only the files that changed
 
 Usage:
+  vprune bench-strategies [options] INPUTFILE
+  vprune generate-tcx [options] OUTPUTFILE
+  vprune benchmark [options]
   vprune [options] [INPUTFILE]
   vprune -h
   vprune --help    
 
 Options:
-  INPUTFILE         .TCX input filename.  If none supplied on command line a GUI window will pop up to ask you to find the file.
+  INPUTFILE         .TCX (or .GPX) input filename, or - to read a .tcx file from stdin.  If none supplied on command line a GUI window will pop up to ask you to find the file.
   -h --help     Show this.
 
   --maxturns <max # of turns/CoursePoints before file is split>  [Default: --maxturns 80]
@@ -163,14 +197,66 @@ Options:
 
   --overlap_num <# of turns to overlap when splitting files>
 
+  --max-km <km>       Also split so that no file covers more than this distance
+  --max-hours <hours>  Also split so that no file covers more than this much (planned) riding time
+  --max-trackpoints-per-file <#>  Also split so that no file starts out with more than this many Trackpoints
+                      The --max-... limits can be combined with each other and with --maxturns/--split; splits are always made at a turn
+  --balance <measure>  Choose where to split so the biggest file is as small as possible, measured in turns, trackpoints or bytes
+                      (same number of files; --maxturns and the --max-... limits still apply)
+
   --maxpoints <# of Trackpoints in each output file>      [Default: --maxpoints 500]
   --percent <pct 0-100 of Trackpoints to retain>          [Specify --maxpoints OR --percent, not both]
+                      Give several, ie --maxpoints 250,500,1500 or --percent 10,25, for a set of files for each (same split,
+                      prefixed vp_250_, vp_500_, ... or vp_10pct_, vp_25pct_, ...)
+  --strategy <name>   How to choose Trackpoints to remove: random OR vw OR spacing  [Default: random]
+                      vw (Visvalingam-Whyatt) removes the least significant points first
+                      random and vw both keep exactly --maxpoints in each file
+                      spacing keeps points --min-gap apart, never more than --max-gap apart (ignores --maxpoints/--percent)
+  --min-gap <metres>  spacing strategy: minimum distance between kept Trackpoints  [Default: 100]
+  --max-gap <metres>  spacing strategy: maximum distance between kept Trackpoints  [Default: 400]
+  --turn-radius <metres>  Spend more of the Trackpoints near turns: points within this distance of a turn
+                          get --turn-share of each file's Trackpoints (random and vw strategies; 0 = off)  [Default: 0]
+  --turn-share <pct>  Percent of the removable Trackpoints to spend within --turn-radius of turns  [Default: 50]
+  --distances <mode>  Trackpoint distances: file (use the file's DistanceMeters; any that are missing carry on from the one before by lat & long),
+                      check (as file, but also report how far the file's distances are from lat & long) or compute (recompute them all)  [Default: file]
+  --fidelity          For each output file, print how far (max & mean, in meters) the removed Trackpoints are from the route
+                      that is left, and where the worst stretch is (--report saves these too)
+  --seed <int>        Seed for the random strategy; the same seed always gives the same output files  [Default: 0]
 
   --cleancourse   Strip all Generic CoursePoints.      [Default: No cleancourse]
   --nocleannotes  Do not eliminate all Notes in CoursePoints. [Default: Eliminate all Notes]
   --trimnotes     Trim notes to 32 characters and remove any potentially troublesome characters (also forces --nocleannotes)
+  --rules <file>  Your own cleanup rules, applied to each Course after the ones above: a JSON list like
+                  [{"name": "nodanger", "path": "ns1:CoursePoint[ns1:PointType='Danger']", "action": "remove"},
+                   {"name": "road", "path": "ns1:CoursePoint/ns1:Notes", "action": "replace", "pattern": "Road", "replacement": "Rd"}]
+                  path is an XPath from the Course, with ns1: for the TCX namespace; replace is a regular expression substitution
 
   --prefix <string>   Prefix output filenames with this string [Default: vp_]
+  --format <format>   Write the output files as tcx OR gpx OR fit (FIT course files, smaller & quicker for many GPS units to load)
+                      If not given, the output files are the same format as the input file
+  --compact           Make the output files smaller: strip the indenting, round lat/long to --decimals places, round distances & times
+                      to whole numbers and drop what the GPS unit doesn't need (altitude, heart rate, cadence, extensions, empty Notes)
+  --decimals <#>      --compact: decimal places to keep in latitude & longitude (5 places is about 1 m)  [Default: 5]
+  --dry-run           Don't process the file: scan it (.tcx only, very quickly, even for huge files) and print the counts, the
+                      split plan and each output file's turns, trackpoints & rough size
+  --out-tar <file>    Put the output files in this tar file instead of next to the input file (- for stdout; each file goes into
+                      the tar as soon as it is done, and everything VPrune prints goes to stderr)
+  --delta             Keep a fingerprint of each output file's part of the route in <prefix><inputfile>.delta.json, and on the
+                      next --delta run over a new version of the route, rewrite only the output files whose part has changed
+  --jobs <n>          Files with several Courses: process up to this many Courses at once (0 = one per CPU)  [Default: 0]
+  --profile           At the end of the run, print the time taken by each stage (parse, count, segment, prune, cleanup, rename, write)
+                      and by each output file, in seconds & trackpoints/second
+  --cprofile <file>   As --profile, and also write a full cProfile dump to <file> (Courses are then processed one at a time, in this process)
+  --report <file>     Save a JSON report of the run: the input file's size & counts, the options used and, for each output file,
+                      its turns, trackpoints kept & removed, coursepoints, distance, duration, size, name and time taken
+  --memtrace          At the end of the run, print the peak & retained memory of each stage, the process's resident memory (RSS)
+                      and the places in the code holding the most memory (slows the run; Courses are processed one at a time)
+
+  --trackpoints <#>   generate-tcx: number of Trackpoints in the made-up route  [Default: 10000]
+  --turn-every <#>    generate-tcx: average number of Trackpoints between turns (busier & quieter stretches either side of it)  [Default: 20]
+  --sizes <list>      benchmark: comma separated route sizes, in Trackpoints  [Default: 10000,100000]
+  --baseline <file>   benchmark: compare the timings with this JSON file, or save them there if it does not exist yet
+  --threshold <pct>   benchmark: report a regression when a stage is this much slower than the baseline  [Default: 20]
   
   --gui               Force GUI mode
   --webgui            Force WebGUI mode (access via web browser at URL localhost:8081)  
@@ -181,8 +267,22 @@ Options:
 
 #from __future__ import print_function
 
-import re, sys, os,random, datetime, math, copy, html, time, platform #, pytz
-from io import StringIO
+import re, sys, os,random, datetime, math, copy, html, time, platform, heapq, bisect, tempfile, shutil, json, cProfile, tracemalloc, struct, mmap, tarfile, zipfile, threading, http.server, hashlib #, pytz
+from io import StringIO, BytesIO, TextIOWrapper
+from contextlib import redirect_stdout, redirect_stderr, contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+try:
+	import resource
+except ImportError:
+	resource = None #Not on Windows: --memtrace then reports resident memory only where /proc is available
+
+#With --out-tar -, stdout carries the tar stream, so everything VPrune prints goes to stderr instead
+tar_stdout = None
+if '--out-tar=-' in sys.argv or any(arg == '--out-tar' and value == '-' for arg, value in zip(sys.argv, sys.argv[1:])):
+	tar_stdout = sys.stdout.buffer
+	sys.stdout = sys.stderr
 
 try:
   import tkinter
@@ -224,7 +324,8 @@ except ImportError:
 	print()
 	sys.exit()
  
-args = docopt(__doc__)   
+#Only parse the command line when run as a program, so the tests can import this module
+args = docopt(__doc__, argv=None if __name__ == "__main__" else [])   
 
 ''' options to force GUI or webGUI, and print the info message necessary ''' 
 forcegui = False
@@ -339,14 +440,67 @@ except ImportError:
 					print("Failed to import ElementTree from any known place")
 	'''
 
+try:
+  import numpy as np
+  #print("running with numpy")
+except ImportError:
+	print()
+	print("************ERROR************************")
+	print("numpy module not imported--probably because the numpy module is not installed. Without numpy, VPrune cannot run at all.")
+	print("If you want to fix the problem: At the console, run command 'pip install numpy'")
+	print ("and then try again")
+	print("************ERROR************************")
+	print()
+	sys.exit()
+
 ns1 = 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'
 ns2 = 'http://www.garmin.com/xmlschemas/ActivityExtension/v2'
 prefix = "vp_"
+output_format = ""
+compact = False
+decimals = 5
+strategy = "random"
+seed = 0
+max_km = 0
+max_hours = 0
+max_trackpoints_per_file = 0
+balance = ''
+jobs = 0
+min_gap = 100
+max_gap = 400
+turn_radius = 0
+turn_share = 50
+distances = 'file'
+measure_error = False
+route_error = {}
+fidelity = False
+fidelity_stats = {}
+delta = False
+keep_altitude = False
+timing = False
+stage_times = {}
+stage_names = ['parse', 'count', 'segment', 'prune', 'fidelity', 'cleanup', 'rename', 'write']
+profile_file = ''
+segment_stats = []
+memtrace = False
+stage_memory = {}
+memoize = False
+stage_memo = {}
+memo_limit = 256
 gui = False
 num_courses = 0
 num_tracks = 0
 num_trackpoints = 0
 num_coursepoints = 0
+num_window_trackpoints = 0
+compact_saved_bytes = 0
+out_archive = None      #--out-tar's tarfile, or the web GUI's zipfile: output files go in it instead of to disk
+out_archive_file = None
+output_sizes = {}
+download = {'name': '', 'data': b''}
+download_host = '127.0.0.1'    #The download is unauthenticated: only this machine's browser may fetch it
+download_port = 8082
+download_server = None
 orig_total_courses = 0
 orig_total_tracks = 0
 orig_total_trackpoints = 0
@@ -356,12 +510,14 @@ progress_bar = []
 progress = 0
 
 def initVals():
-	global num_courses,num_tracks,	num_trackpoints, num_coursepoints, orig_total_courses, orig_total_tracks, orig_total_trackpoints, orig_total_coursepoints, progress_window,	progress_bar, progress
+	global num_courses,num_tracks,	num_trackpoints, num_coursepoints, num_window_trackpoints, compact_saved_bytes, orig_total_courses, orig_total_tracks, orig_total_trackpoints, orig_total_coursepoints, progress_window,	progress_bar, progress, route_error, segment_stats
 
 	num_courses = 0
 	num_tracks = 0
 	num_trackpoints = 0
 	num_coursepoints = 0
+	num_window_trackpoints = 0
+	compact_saved_bytes = 0
 	orig_total_courses = 0
 	orig_total_tracks = 0
 	orig_total_trackpoints = 0
@@ -369,15 +525,87 @@ def initVals():
 	progress_window = []
 	progress_bar = []
 	progress = 0
+	route_error = {'max': 0.0, 'sum': 0.0, 'count': 0}
+	segment_stats = []
 
 initVals()
 
+@contextmanager
+def stage(name):
+	#Add the time (and with --memtrace, the memory) used in this block to stage_times[name]; does nothing unless switched on
+	if not timing and not memtrace:
+		yield
+		return
+	if memtrace:
+		if hasattr(tracemalloc, 'reset_peak'): #Python 3.9+
+			tracemalloc.reset_peak()
+		traced_before, peak_before = tracemalloc.get_traced_memory()
+		rss_before = rss_bytes()
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		if timing:
+			stage_times[name] = stage_times.get(name, 0.0) + time.perf_counter() - start
+		if memtrace:
+			traced, traced_peak = tracemalloc.get_traced_memory()
+			if traced_peak <= peak_before:
+				#No new peak in this block (or, before Python 3.9, one from earlier we couldn't reset): count what it holds now
+				traced_peak = max(traced, traced_before)
+			rss = rss_bytes()
+			memory = stage_memory.setdefault(name, {'calls': 0, 'peak': 0, 'retained': 0, 'rss': 0, 'rss_growth': 0})
+			memory['calls'] += 1
+			memory['peak'] = max(memory['peak'], traced_peak - traced_before)
+			memory['retained'] += traced - traced_before
+			memory['rss'] = max(memory['rss'], rss)
+			memory['rss_growth'] += rss - rss_before
+
+def rss_bytes():
+	#Resident memory of this process now (Linux & Android); elsewhere the most it has used so far
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError, AttributeError):
+		return peak_rss_bytes()
+
+def peak_rss_bytes():
+	#The most resident memory this process has used; 0 if the platform can't tell us
+	if resource is None:
+		return 0
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == 'darwin' else peak * 1024
+
 def isInt(s):
     try:
         return float(str(s)).is_integer()
     except:
         return False
 
+def number_option(arguments, option, low=0, low_ok=False, high=None):
+	"""
+	The value of a numeric command line option, or None if it was not given.  Prints an error & exits unless it is a
+	number above low (or equal to it, if low_ok) and at most high.
+	"""
+	value = arguments[option]
+	if value is None or value == '':
+		return None
+	try:
+		number = float(value)
+		ok = math.isfinite(number) and (number > low or (low_ok and number == low)) and (high is None or number <= high)
+	except ValueError:
+		ok = False
+	if not ok:
+		if high is not None:
+			expected = "from %g to %g" % (low, high)
+		else:
+			expected = ("at least %g" if low_ok else "greater than %g") % low
+		print()
+		print ('*******ERROR**********')
+		print ("%s must be a number %s, not '%s'" % (option, expected, value))
+		print ('*******ERROR**********')
+		sys.exit(-1)
+	return number
+
 
 def checkbox_to_radio(window, event, values, delimiter='_'):
 	"""
@@ -433,47 +661,6 @@ def checkbox_to_radio(window, event, values, delimiter='_'):
 #keyname can be like "folders" "courses/course"
 #
 #TCX names should be only 15 chars long so then it trims to 15 chars
-def replace_first_chars_entry(parent, keyname, prefix, nsmap):
-	#sys.stderr.write(keyname + prefix + "\n")
-	#for element in parent.iter(keyname):
-	#	sys.stderr.write("%s - %s" % (element.tag, element.text) + "\n")
-	#sys.stderr.flush
-
-	entries = parent.xpath(keyname, namespaces=nsmap)
-	#sys.stderr.write(str(len(entries)) + "\n")
-
-	for entry in entries:
-		sys.stderr.write("%s - %s" % (entry.tag, entry.text) + "\n")
-		if (entry.text is not None):
-			entry.text = (prefix + entry.text)[:15] # trim to 15 chars
-		else:
-			entry.text = prefix[:15] # trim to 15 chars
-		sys.stderr.write("%s - %s" % (entry.tag, entry.text) + "\n")
-	sys.stderr.flush
-	return
-	#entries = parent.findall('.//{%s}'%ns1 + keyname) # .// makes it find the tag anywhere, not just as the first-level child tag
-	#sys.stderr.write(str(etree.tostring(parent, pretty_print=True)))
-	sys.stderr.write(keyname +"\n")
-	entries = parent.xpath(keyname)
-	sys.stderr.write(str(len(entries)) + "\n")
-	#entries = parent.findall('./Lap')
-    # update if entry already exists.
-	#sys.stderr.write(entries)
-	#if index <= len(entries):
-	#	entry = entries[index - 1]
-		#for child in entry.iter():
-			#print (type(child))
-
-			#print(child.tag, child.text, child.tail)
-	for entry in entries:
-		sys.stderr.write(str(etree.tostring(entry, pretty_print=True)))
-		#print(entry.text)
-		#print(entry.tag)		
-		sys.stderr.write(entry.text +"\n")
-		if (entry.text is not None):
-				entry.text = (prefix + entry.text)[:15] # trim to 15 chars
-	sys.stderr.flush
-
 # from https://stackoverflow.com/questions/26523929/add-update-elements-at-position-using-lxml-python
 #goes through all the entries in a given dictionary, and if that entry exists in the table at the given parent, then update the corresponding entry to match the dictionary.  Preset to work only with <lap> elements
 def upsert_entry(parent, index, insertdict, begindict, enddict):
@@ -541,149 +728,745 @@ def check_time(track, time, times):
 		return 'must keep'		
 	return 'may eliminate'
 	
+def snap_coursepoints(root):
+	"""
+	Pinning & splitting find a turn's Trackpoint by an exact match of the CoursePoint's Time with a Trackpoint's Time.
+	Exports from other planners may have CoursePoint Times that are a little off, or none at all: give each such
+	CoursePoint the Time of the nearest Trackpoint (by position, or by time if it has no position) between the
+	CoursePoints either side of it, so turns stay in order along the route.  Returns how many CoursePoints were moved.
+	"""
+	snapped = 0
+	for course in root.iter('{%s}Course'%ns1):
+		coursepoints = course.findall('{%s}CoursePoint'%ns1)
+		#Quick check first: usually (RideWithGPS) every CoursePoint Time is a Trackpoint Time
+		track_times = set(elem.text for track in course.iter('{%s}Track'%ns1) for elem in track.iter('{%s}Time'%ns1))
+		if all(cp.findtext('{%s}Time'%ns1) in track_times for cp in coursepoints):
+			continue
+		trackpoints = course.findall('{%s}Track/{%s}Trackpoint'%(ns1,ns1))
+		times = trackpoint_texts(course, trackpoints, 'Time', '')
+		index = dict(zip(reversed(times), range(len(times) - 1, -1, -1))) #first Trackpoint with each Time
+		index.pop('', None)
+		found = [index.get(cp.findtext('{%s}Time'%ns1, ''), -1) for cp in coursepoints]
+		if not index:
+			continue #no Trackpoint Times to snap to
+		cp_times = [cp.findtext('{%s}Time'%ns1, '') for cp in coursepoints]
+		matches = snap_matches(found, time_seconds(times).astype(float), np.array([bool(t) for t in times]),
+			np.array(trackpoint_texts(course, trackpoints, 'Position/LatitudeDegrees', 'nan'), dtype=float),
+			np.array(trackpoint_texts(course, trackpoints, 'Position/LongitudeDegrees', 'nan'), dtype=float),
+			[float(cp.findtext('{%s}Position/{%s}LatitudeDegrees'%(ns1,ns1), 'nan')) for cp in coursepoints],
+			[float(cp.findtext('{%s}Position/{%s}LongitudeDegrees'%(ns1,ns1), 'nan')) for cp in coursepoints],
+			[float(time_seconds([t])[0]) if t else math.nan for t in cp_times])
+		for j, cp in enumerate(coursepoints):
+			i = matches[j]
+			if found[j] < 0 and i >= 0:
+				time_elem = cp.find('{%s}Time'%ns1)
+				if time_elem is None:
+					#TCX wants the Time right after the Name
+					time_elem = etree.Element('{%s}Time'%ns1)
+					name = cp.find('{%s}Name'%ns1)
+					cp.insert(0 if name is None else cp.index(name) + 1, time_elem)
+					time_elem.tail = cp.text if name is None else name.tail
+				time_elem.text = times[i]
+				snapped += 1
+	return snapped
+
+def snap_matches(found, seconds, has_time, lats, lons, cp_lats, cp_lons, cp_seconds):
+	"""
+	The Trackpoint of each CoursePoint, as snap_coursepoints finds it, from arrays: found[j] is the Trackpoint the j'th
+	CoursePoint's Time matched (-1 if none), seconds & has_time the Trackpoints' times, lats & lons their positions, and
+	cp_lats, cp_lons & cp_seconds the CoursePoints' (nan where missing).  -1 for a CoursePoint that can't be snapped.
+	"""
+	found = list(found)
+	grid = None
+	#A CoursePoint that needs snapping goes no further than the next one that matched
+	upper = [len(seconds)] * len(found)
+	for j in range(len(found) - 2, -1, -1):
+		upper[j] = found[j + 1] + 1 if found[j + 1] >= 0 else upper[j + 1]
+	lo = 0
+	for j in range(len(found)):
+		if found[j] < 0:
+			i = -1
+			if not (math.isnan(cp_lats[j]) or math.isnan(cp_lons[j])):
+				if grid is None:
+					grid = grid_index(lats, lons)
+				i = grid_nearest(grid, cp_lats[j], cp_lons[j], lo, upper[j])
+			elif not math.isnan(cp_seconds[j]) and upper[j] > lo:
+				i = lo + int(np.argmin(np.abs(seconds[lo:upper[j]] - cp_seconds[j])))
+			if i >= 0 and has_time[i]:
+				found[j] = i
+		lo = max(lo, found[j])
+	return found
+
+def trackpoint_texts(course, trackpoints, path, default):
+	#The text at path (eg Position/LatitudeDegrees) in each of the Course's Trackpoints: in one sweep of the Tracks if every
+	#Trackpoint has it, else Trackpoint by Trackpoint
+	tag = '{%s}%s' % (ns1, path.split('/')[-1])
+	texts = [elem.text or default for track in course.iter('{%s}Track'%ns1) for elem in track.iter(tag)]
+	if len(texts) == len(trackpoints):
+		return texts
+	return [tp.findtext('/'.join('{%s}%s' % (ns1, step) for step in path.split('/')), default) for tp in trackpoints]
+
+def grid_index(lats, lons, cell=None):
+	"""
+	A uniform grid over route points for fast nearest-point lookups (grid_nearest).  Points are projected to meters as in
+	local_xy; cells are twice the median spacing between points (at least 10 m) unless cell says otherwise.
+	"""
+	lats = fill_missing(lats)
+	lons = fill_missing(lons)
+	scale = math.cos(math.radians(float(np.mean(lats)))) if len(lats) else 1.0
+	y = np.radians(lats) * 6371008.8
+	x = np.radians(lons) * 6371008.8 * scale
+	if cell is None:
+		spacing = np.hypot(np.diff(x), np.diff(y))
+		cell = max(2 * float(np.median(spacing)) if len(spacing) else 0.0, 10.0)
+	x0 = float(x.min()) if len(x) else 0.0
+	y0 = float(y.min()) if len(y) else 0.0
+	cx = ((x - x0) // cell).astype(np.int64)
+	cy = ((y - y0) // cell).astype(np.int64)
+	rows = int(cy.max()) + 1 if len(cy) else 1
+	cols = int(cx.max()) + 1 if len(cx) else 1
+	order = np.argsort(cx * rows + cy, kind='stable')
+	keys, starts = np.unique((cx * rows + cy)[order], return_index=True)
+	return {'x': x, 'y': y, 'scale': scale, 'cell': cell, 'x0': x0, 'y0': y0, 'rows': rows, 'cols': cols,
+		'keys': keys, 'starts': starts, 'ends': np.append(starts[1:], len(order)), 'order': order}
+
+def grid_nearest(grid, lat, lon, lo=0, hi=None):
+	"""
+	Number of the point in grid nearest to lat, lon, looking only at points lo to hi-1 (-1 if there are none).  Searches
+	rings of cells outwards from the cell lat, lon is in, until no point further out could be nearer; if the rings get
+	bigger than the number of points to choose from, just measures to all of those instead.
+	"""
+	hi = len(grid['x']) if hi is None else hi
+	if hi <= lo:
+		return -1
+	px = math.radians(lon) * 6371008.8 * grid['scale']
+	py = math.radians(lat) * 6371008.8
+	cell = grid['cell']
+	rows = grid['rows']
+	cx = int((px - grid['x0']) // cell)
+	cy = int((py - grid['y0']) // cell)
+	best, best_d = -1, float('inf')
+	r = 0
+	while best_d > (r - 1) * cell:
+		if 8 * r > hi - lo or r > max(abs(cx), abs(cx - grid['cols']), abs(cy), abs(cy - rows)):
+			d = np.hypot(grid['x'][lo:hi] - px, grid['y'][lo:hi] - py)
+			return lo + int(np.argmin(d))
+		#The cells r out from lat, lon's cell
+		side = np.arange(cx - r, cx + r + 1)
+		inner = np.arange(cy - r + 1, cy + r)
+		ring_x = np.concatenate([side, side, np.full(len(inner), cx - r), np.full(len(inner), cx + r)]) if r else np.array([cx])
+		ring_y = np.concatenate([np.full(len(side), cy - r), np.full(len(side), cy + r), inner, inner]) if r else np.array([cy])
+		inside = (ring_x >= 0) & (ring_x < grid['cols']) & (ring_y >= 0) & (ring_y < rows)
+		wanted = ring_x[inside] * rows + ring_y[inside]
+		k = np.minimum(np.searchsorted(grid['keys'], wanted), len(grid['keys']) - 1)
+		for j in k[grid['keys'][k] == wanted].tolist():
+			candidates = grid['order'][grid['starts'][j]:grid['ends'][j]]
+			candidates = candidates[(candidates >= lo) & (candidates < hi)]
+			if len(candidates):
+				d = np.hypot(grid['x'][candidates] - px, grid['y'][candidates] - py)
+				i = int(np.argmin(d))
+				if d[i] < best_d:
+					best, best_d = int(candidates[i]), float(d[i])
+		r += 1
+	return best
+
+
+def track_arrays(track):
+	"""
+	Gather the Trackpoints of a track into arrays (Time, Latitude, Longitude, DistanceMeters) in a single pass over the track.
+	"""
+	trackpoints = []
+	times = []
+	lats = []
+	lons = []
+	dists = []
+	for child in track:
+		if child.tag == '{%s}Trackpoint'%ns1:
+			trackpoints.append(child)
+			times.append(child.findtext('{%s}Time'%ns1, ''))
+			lats.append(child.findtext('{%s}Position/{%s}LatitudeDegrees'%(ns1,ns1), 'nan'))
+			lons.append(child.findtext('{%s}Position/{%s}LongitudeDegrees'%(ns1,ns1), 'nan'))
+			dists.append(child.findtext('{%s}DistanceMeters'%ns1, 'nan'))
+	points = {'trackpoints': trackpoints,
+			'time': np.array(times, dtype=str),
+			'seconds': time_seconds(times),
+			'lat': np.array(lats, dtype=float),
+			'lon': np.array(lons, dtype=float),
+			'dist': np.array(dists, dtype=float)}
+	if distances == 'compute':
+		points['dist'] = route_distances(points['lat'], points['lon'])
+	elif np.isnan(points['dist']).any():
+		points['dist'] = fill_distances(points['dist'], route_distances(points['lat'], points['lon']))
+	return points
+
+def route_tracks(tree):
+	"""
+	track_arrays of every Track of each Course in tree, read once for all the output files, and a copy of tree with every Track
+	emptied.  Each output file starts as a copy of that skeleton, and gets copies of just the Trackpoints it keeps.
+	"""
+	root = tree.getroot()
+	tracks = [[track_arrays(track) for track in course.iter('{%s}Track'%ns1)] for course in root.iter('{%s}Course'%ns1)]
+	skeleton = copy.deepcopy(tree)
+	for track in skeleton.getroot().iter('{%s}Track'%ns1):
+		del track[:]
+	return tracks, skeleton
+
+def fill_distances(dist, computed):
+	"""
+	The file's distances with the missing (NaN) ones filled in: each carries on from the last distance in the file before it
+	by the distance along lat & long (computed, cumulative) since then.  Missing ones before the first are counted from 0.
+	"""
+	missing = np.isnan(dist)
+	last = np.maximum.accumulate(np.where(missing, -1, np.arange(len(dist))))
+	filled = dist.copy()
+	before = missing & (last < 0)
+	filled[before] = computed[before]
+	after = missing & (last >= 0)
+	filled[after] = dist[last[after]] + computed[after] - computed[last[after]]
+	return filled
+
+def route_distances(lats, lons):
+	"""
+	Cumulative haversine distance in metres along the points, from their lat & long.
+	"""
+	lat = np.radians(fill_missing(lats))
+	lon = np.radians(fill_missing(lons))
+	a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+	dist = np.zeros(len(lat))
+	dist[1:] = np.cumsum(2 * 6371008.8 * np.arcsin(np.sqrt(np.minimum(a, 1))))
+	return dist
+
+def check_distances(points):
+	"""
+	Compare a track's DistanceMeters with the distance worked out from its positions and print how far apart they are.
+	"""
+	if len(points['dist']) < 2:
+		return
+	computed = route_distances(points['lat'], points['lon'])
+	filed = points['dist'] - points['dist'][0]
+	worst = float(np.max(np.abs(filed - computed)))
+	total = float(computed[-1])
+	difference = 100 * (float(filed[-1]) - total) / total if total > 0 else 0
+	print ("Distance check: file says %s meters, positions give %s meters (%+.1f%%); largest difference at any Trackpoint %s meters"%(round(float(filed[-1])), round(total), difference, round(worst)))
+
+def select_points(points, idx):
+	#The same points from every array, eg just the ones in a segment's time window
+	return {key: (value[idx] if isinstance(value, np.ndarray) else [value[i] for i in idx]) for key, value in points.items()}
+
+def time_seconds(times):
+	#TCX times look like 2019-08-03T20:18:46Z; numpy wants them without the trailing Z
+	return np.array([t[:19] if t else 'NaT' for t in times], dtype='datetime64[s]').astype(np.int64)
+
+def segment_budget(n, n_pinned, percent, maxpoints):
+	"""
+	Number of Trackpoints to keep in a segment of n Trackpoints, n_pinned of which can't be removed.
+	"""
+	if maxpoints > 0:
+		budget = maxpoints
+	else:
+		budget = n_pinned + round((n - n_pinned) * percent / 100)
+	return int(min(n, max(budget, n_pinned)))
+
+def track_budgets(pinned, percent, maxpoints):
+	"""
+	Share one output file's budget (segment_budget of all its Trackpoints) among its Tracks, given the pinned array of each
+	Track's window.  Every Track keeps its pinned points and its two end points (vw never removes those), and the rest of the
+	budget goes to the Tracks in proportion to the points they could lose (largest remainder), so the shares add up to
+	exactly the file's budget.
+	"""
+	budget = segment_budget(sum(len(p) for p in pinned), sum(int(p.sum()) for p in pinned), percent, maxpoints)
+	least = [int(p.sum()) + (len(p) > 0 and not p[0]) + (len(p) > 1 and not p[-1]) for p in pinned]
+	free = [len(p) - n for p, n in zip(pinned, least)]
+	spare = max(budget - sum(least), 0)
+	total_free = sum(free)
+	if total_free == 0:
+		return least
+	shares = [spare * f // total_free for f in free]
+	by_remainder = sorted(range(len(free)), key=lambda i: spare * free[i] % total_free, reverse=True)
+	for i in by_remainder[:spare - sum(shares)]:
+		shares[i] += 1
+	return [n + share for n, share in zip(least, shares)]
+
+def random_keep_mask(points, pinned, budget, rng):
+	"""
+	Keep every pinned point plus a random sample of the others--exactly budget points in all, drawn in one go from rng, the segment's seeded generator.
+	"""
+	keep = pinned.copy()
+	free = np.flatnonzero(~pinned)
+	num_free = min(len(free), budget - int(pinned.sum()))
+	if num_free > 0:
+		keep[rng.choice(free, num_free, replace=False)] = True
+	return keep
+
+def segment_rng(segment):
+	"""
+	Random generator for one output file, from the run's --seed and the segment number.  Same seed, same files.
+	"""
+	return np.random.default_rng([seed, segment])
+
+def vw_keep_mask(points, pinned, budget, rng):
+	"""
+	Visvalingam-Whyatt: repeatedly remove the point making the smallest triangle with its two neighbours
+	until exactly budget points are left.  Pinned points and the two end points are never removed.
+
+	Areas live in a min-heap; entries made stale by a neighbour's removal are skipped as they are popped,
+	so the whole thing is O(n log n).
+	"""
+	n = len(pinned)
+	keep = [True] * n
+	if n < 3:
+		return np.array(keep, dtype=bool)
+	fixed = pinned.copy()
+	fixed[0] = fixed[-1] = True
+	to_remove = min(n - budget, n - int(fixed.sum()))
+	if to_remove <= 0:
+		return np.array(keep, dtype=bool)
+
+	#Flat projection in metres around the segment's mean latitude--plenty accurate for ranking small triangles
+	#Trackpoints with no Position are placed between their neighbours
+	x, y = local_xy(points['lat'], points['lon'])
+	areas = np.zeros(n)
+	areas[1:-1] = 0.5 * np.abs((x[:-2] - x[2:]) * (y[1:-1] - y[:-2]) - (x[:-2] - x[1:-1]) * (y[2:] - y[:-2]))
+
+	#Heap keys are plain ints, which compare much faster than (area, index) tuples:
+	#area in 1/1024 m^2 in the high bits, point index in the low bits
+	shift = n.bit_length()
+	mask = (1 << shift) - 1
+	area = np.round(areas * 1024).astype(np.int64).tolist()
+	xs = (x * 32).tolist() # 32*32/2 = 1024/2, so half the cross product comes out in 1/1024 m^2
+	ys = (y * 32).tolist()
+	fixed = fixed.tolist()
+	prev = list(range(-1, n - 1))
+	nxt = list(range(1, n + 1))
+	heap = [(area[i] << shift) | i for i in range(1, n - 1) if not fixed[i]]
+	heapq.heapify(heap)
+
+	heappop = heapq.heappop
+	heappush = heapq.heappush
+	removed = 0
+	while removed < to_remove:
+		k = heappop(heap)
+		i = k & mask
+		a = k >> shift
+		if a != area[i] or not keep[i]:
+			continue #stale entry
+		keep[i] = False
+		removed += 1
+		p = prev[i]
+		q = nxt[i]
+		nxt[p] = q
+		prev[q] = p
+		#Recompute the two neighbours' areas.  A point's effective area never drops below that of a point already removed
+		if not fixed[p]:
+			pp = prev[p]
+			na = int(0.5 * abs((xs[pp] - xs[q]) * (ys[p] - ys[pp]) - (xs[pp] - xs[p]) * (ys[q] - ys[pp])))
+			if na < a:
+				na = a
+			area[p] = na
+			heappush(heap, (na << shift) | p)
+		if not fixed[q]:
+			qq = nxt[q]
+			na = int(0.5 * abs((xs[p] - xs[qq]) * (ys[q] - ys[p]) - (xs[p] - xs[q]) * (ys[qq] - ys[p])))
+			if na < a:
+				na = a
+			area[q] = na
+			heappush(heap, (na << shift) | q)
+	return np.array(keep, dtype=bool)
+
+def spacing_keep_mask(points, pinned, budget, rng):
+	"""
+	Keep a point once at least min_gap metres of route have passed since the last point kept, and never leave
+	more than max_gap metres between kept points (unless the original points are already further apart than that).
+	Pinned points are always kept; budget is not used--the gaps decide how many points there are.
+
+	Jumps from kept point to kept point with binary searches on the cumulative distance, so the cost grows with the
+	number of points kept rather than the number in the track.
+	"""
+	n = len(pinned)
+	keep = np.zeros(n, dtype=bool)
+	if n == 0:
+		return keep
+	dist = np.maximum.accumulate(fill_missing(points['dist'])).tolist()
+	pins = np.flatnonzero(pinned).tolist()
+	cur = 0
+	while cur < n - 1:
+		keep[cur] = True
+		nxt = bisect.bisect_left(dist, dist[cur] + min_gap, cur + 1)              #first point far enough along
+		nxt = min(nxt, bisect.bisect_right(dist, dist[cur] + max_gap, cur + 1) - 1) #last point before the gap gets too big
+		p = bisect.bisect_right(pins, cur)
+		if p < len(pins):
+			nxt = min(nxt, pins[p])                                                #next pinned point
+		cur = max(nxt, cur + 1)
+	keep[n - 1] = True
+	return keep
+
+def local_xy(lats, lons):
+	"""
+	Project lat/lon (degrees) onto a flat x/y plane in metres around the mean latitude.  Missing positions are interpolated.
+	"""
+	lats = fill_missing(lats)
+	lons = fill_missing(lons)
+	y = np.radians(lats) * 6371008.8
+	x = np.radians(lons) * 6371008.8 * math.cos(math.radians(float(np.mean(lats))))
+	return x, y
+
+def fill_missing(values):
+	bad = np.isnan(values)
+	if not bad.any():
+		return values
+	if bad.all():
+		return np.zeros(len(values))
+	idx = np.arange(len(values))
+	values = values.copy()
+	values[bad] = np.interp(idx[bad], idx[~bad], values[~bad])
+	return values
+
+def turn_keep_mask(points, pinned, budget, rng):
+	"""
+	Run the chosen strategy, but spend turn_share percent of the segment's free budget on points within
+	turn_radius meters (along the route) of a turn, and the rest on the stretches in between.
+
+	Done as two runs of the strategy: first the points near turns are cut to their share while the others
+	are held, then the points between turns are cut with the near-turn points held.
+	"""
+	choose = prune_strategies[strategy]
+	if turn_radius <= 0 or not choose.uses_budget or not pinned.any():
+		return choose(points, pinned, budget, rng)
+
+	near = ~pinned & (anchor_distance(points['dist'], pinned) <= turn_radius)
+	far = ~pinned & ~near
+	num_pinned = int(pinned.sum())
+	num_near = int(near.sum())
+	num_far = int(far.sum())
+	free_budget = max(budget - num_pinned, 0)
+	near_budget = min(num_near, round(free_budget * turn_share / 100))
+	near_budget = max(near_budget, free_budget - num_far) #if there aren't enough points between turns, spend the rest near them
+
+	keep = choose(points, pinned | far, num_pinned + num_far + near_budget, rng)
+	sub = np.flatnonzero(keep)
+	keep[sub] = choose(select_points(points, sub), (pinned | near)[sub], max(budget, num_pinned), rng)
+	return keep
+
+def anchor_distance(dist, pinned):
+	"""
+	Distance along the route from each point to the nearest pinned (turn) point.
+	"""
+	anchors = np.sort(dist[pinned])
+	pos = np.searchsorted(anchors, dist)
+	before = anchors[np.clip(pos - 1, 0, len(anchors) - 1)]
+	after = anchors[np.clip(pos, 0, len(anchors) - 1)]
+	return np.minimum(np.abs(dist - before), np.abs(after - dist))
+
+prune_strategies = {}
+
+def register_strategy(name, function, uses_budget=None):
+	"""
+	Make a pruning strategy available to --strategy.
 
-def process_trackpoint(track, trackpoint, percent, times, startT, endT, first_distance, first):
+	function(points, pinned, budget, rng) gets one segment's points as a dict of arrays (lat, lon, dist, seconds, time),
+	a boolean array of the points that must be kept, the number of points to keep and the output file's random generator
+	(numpy, seeded from --seed & the file's number, for strategies that make random choices).  It returns a boolean keep array.
+	Strategies that decide the number of points themselves (like spacing) are registered with uses_budget=False.
+	"""
+	if uses_budget is None:
+		uses_budget = getattr(function, 'uses_budget', True)
+	function.uses_budget = uses_budget
+	prune_strategies[name] = function
+
+register_strategy('random', random_keep_mask)
+register_strategy('vw', vw_keep_mask)
+register_strategy('spacing', spacing_keep_mask, uses_budget=False)
+
+def load_plugin_strategies():
+	"""
+	Register strategies from other installed packages, declared as 'vprune.strategies' entry points:
+	    [project.entry-points."vprune.strategies"]
+	    mystrategy = "mypackage.module:keep_mask_function"
+	"""
+	try:
+		from importlib.metadata import entry_points
+	except ImportError:
+		return
+	try:
+		plugins = entry_points(group='vprune.strategies')
+	except TypeError:
+		plugins = entry_points().get('vprune.strategies', []) #python 3.8 & 3.9
+	for plugin in plugins:
+		try:
+			register_strategy(plugin.name, plugin.load())
+		except Exception as e:
+			print ("Could not load pruning strategy '%s': %s" % (plugin.name, e))
+
+load_plugin_strategies()
+
+def dropped_deviation(lats, lons, keep):
+	"""
+	Distance in meters from each dropped point to the line between the kept points either side of it.
+	"""
+	n = len(keep)
+	if n == 0 or not keep.any():
+		return np.zeros(0)
+	x, y = local_xy(lats, lons)
+	idx = np.arange(n)
+	prev = np.maximum.accumulate(np.where(keep, idx, -1))
+	nxt = np.minimum.accumulate(np.where(keep, idx, n)[::-1])[::-1]
+	drop = ~keep
+	a = np.where(prev < 0, nxt, prev)[drop]
+	b = np.where(nxt >= n, prev, nxt)[drop]
+	return segment_distance(x[drop], y[drop], x[a], y[a], x[b], y[b])
+
+def segment_distance(px, py, ax, ay, bx, by):
+	#Distance from each point p to the line segment a-b (all arrays, in meters)
+	dx = bx - ax
+	dy = by - ay
+	length2 = dx * dx + dy * dy
+	t = np.clip(((px - ax) * dx + (py - ay) * dy) / np.where(length2 > 0, length2, 1), 0, 1)
+	return np.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+def polyline_deviation(lats, lons, keep, chunk=1000000):
+	"""
+	Distance in meters from each dropped point to the nearest part of the kept route (which may be another pass along
+	the same road, not just the stretch the point was dropped from).  The kept segments go in a uniform grid with cells
+	about one segment long, so each point is only checked against the segments in the 3x3 cells around it; the few
+	points further than a cell from the kept route are checked against every segment.
+	"""
+	best = dropped_deviation(lats, lons, keep) #the distance to the point's own stretch; the nearest can't be further
+	kept = np.flatnonzero(keep)
+	if len(kept) < 2 or len(best) == 0:
+		return best
+	x, y = local_xy(lats, lons)
+	ax, ay, bx, by = x[kept[:-1]], y[kept[:-1]], x[kept[1:]], y[kept[1:]]
+	px, py = x[~keep], y[~keep]
+	cell = max(float(np.median(np.hypot(bx - ax, by - ay))), 1.0)
+	x0, y0 = float(x.min()), float(y.min())
+	rows = int((float(y.max()) - y0) // cell) + 3
+	def cell_of(cx, cy):
+		return (cx + 1) * rows + cy + 1
+
+	#Each segment goes in every cell its bounding box covers
+	cx0 = ((np.minimum(ax, bx) - x0) // cell).astype(np.int64)
+	cy0 = ((np.minimum(ay, by) - y0) // cell).astype(np.int64)
+	width = ((np.maximum(ax, bx) - x0) // cell).astype(np.int64) - cx0 + 1
+	height = ((np.maximum(ay, by) - y0) // cell).astype(np.int64) - cy0 + 1
+	counts = width * height
+	k = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+	h = np.repeat(height, counts)
+	cells = cell_of(np.repeat(cx0, counts) + k // h, np.repeat(cy0, counts) + k % h)
+	order = np.argsort(cells, kind='stable')
+	cells = cells[order]
+	segments = np.repeat(np.arange(len(ax)), counts)[order]
+
+	#Candidate (point, segment) pairs from the 3x3 cells around each point
+	pcx = ((px - x0) // cell).astype(np.int64)
+	pcy = ((py - y0) // cell).astype(np.int64)
+	around = np.array([(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)])
+	keys = cell_of(pcx[:, None] + around[:, 0], pcy[:, None] + around[:, 1]).ravel()
+	start = np.searchsorted(cells, keys, 'left')
+	found = np.searchsorted(cells, keys, 'right') - start
+	point = np.repeat(np.arange(len(keys)) // len(around), found)
+	pair = np.repeat(start, found) + np.arange(int(found.sum())) - np.repeat(np.cumsum(found) - found, found)
+	s = segments[pair]
+	if len(s):
+		d = segment_distance(px[point], py[point], ax[s], ay[s], bx[s], by[s])
+		first = np.flatnonzero(np.r_[True, point[1:] != point[:-1]])
+		best[point[first]] = np.minimum(best[point[first]], np.minimum.reduceat(d, first))
+
+	far = np.flatnonzero(best > cell)
+	step = max(1, chunk // len(ax))
+	for i in range(0, len(far), step):
+		f = far[i:i + step]
+		d = segment_distance(px[f, None], py[f, None], ax, ay, bx, by)
+		best[f] = np.minimum(best[f], d.min(axis=1))
+	return best
+
+def add_fidelity(points, keep):
+	"""
+	--fidelity: add the deviation of this Track's dropped points from the kept route to fidelity_stats, noting the worst stretch.
+	"""
+	deviation = polyline_deviation(points['lat'], points['lon'], keep)
+	if not len(deviation):
+		return
+	fidelity_stats['count'] += len(deviation)
+	fidelity_stats['sum'] += float(deviation.sum())
+	i = int(np.argmax(deviation))
+	if deviation[i] >= fidelity_stats['max']:
+		fidelity_stats['max'] = float(deviation[i])
+		#The worst stretch runs between the kept points either side of the worst dropped point
+		j = np.flatnonzero(~keep)[i]
+		kept = np.flatnonzero(keep)
+		k = np.searchsorted(kept, j)
+		a = kept[k - 1] if k > 0 else j
+		b = kept[k] if k < len(kept) else j
+		fidelity_stats['worst'] = {'deviation': float(deviation[i]), 'from_km': float(points['dist'][a]) / 1000, 'to_km': float(points['dist'][b]) / 1000,
+			'from_time': str(points['time'][a]), 'to_time': str(points['time'][b])}
+
+def fidelity_summary():
+	#What --fidelity found in the current output file
+	if not fidelity_stats.get('count'):
+		return {'dropped': 0, 'max': 0.0, 'mean': 0.0, 'worst': None}
+	return {'dropped': fidelity_stats['count'], 'max': fidelity_stats['max'], 'mean': fidelity_stats['sum'] / fidelity_stats['count'], 'worst': fidelity_stats['worst']}
+
+
+def process_trackpoint(track, trackpoint, distance):
+	"""
+	Tidy up a kept Trackpoint: drop AltitudeMeters (unless keep_altitude) and set DistanceMeters (already rebased to the start
+	of the segment).
+	"""
 	global num_trackpoints
-	returndict={}
-	for child in trackpoint:
-		#print ("child")
-		for elem in child.iter():
-			#print ("elem")
-			#print (elem.tag)
-			if (elem.tag == '{%s}Time'%ns1):
-				time=elem.text
-				returndict['{%s}Time'%ns1] = time
-				#print (time)
-				courseT = datetime.datetime.strptime(time, "%Y-%m-%dT%H:%M:%SZ")
-				if (courseT < startT or courseT > endT):
-					trackpoint.getparent().remove(trackpoint)
-					return {} # return empty dictionary if we're deleting this point
-				elif ((random.randint(1,100) > percent) and (check_time(track, time, times) == "may eliminate")):
-					trackpoint.getparent().remove(trackpoint)
-					return {} # return empty dictionary if we're deleting this point
-				else:
-					num_trackpoints += 1
-			#if ( elem.tag == '{%s}AltitudeMeters'%ns1 or elem.tag == '{%s}DistanceMeters'%ns1 ):
-			
-			if  (elem.tag == '{%s}DistanceMeters'%ns1):
-				returndict['{%s}DistanceMeters'%ns1] = elem.text
-				if (first):
-					elem.text = "0"
-				else:
-					elem.text = str(round(float(elem.text)-float(first_distance),2))
-				#print (elem.text)
-				#trackpoint.remove(elem)
-			if  (elem.tag == '{%s}LatitudeDegrees'%ns1):
-				returndict['{%s}LatitudeDegrees'%ns1] = elem.text
-				#print (elem.text)
-			if  (elem.tag == '{%s}LongitudeDegrees'%ns1):
-				returndict['{%s}LongitudeDegrees'%ns1] = elem.text
-				#print (elem.text)
-			if ( elem.tag == '{%s}AltitudeMeters'%ns1):
+	num_trackpoints += 1
+	has_distance = False
+	for elem in list(trackpoint):
+		if (elem.tag == '{%s}AltitudeMeters'%ns1):
+			if not keep_altitude:
 				trackpoint.remove(elem)
+		elif (elem.tag == '{%s}DistanceMeters'%ns1):
+			elem.text = distance
+			has_distance = True
+	if not has_distance:
+		#Distance was computed from the positions; keep the indenting of the other child elements
+		last = trackpoint[-1] if len(trackpoint) else None
+		elem = etree.SubElement(trackpoint, '{%s}DistanceMeters'%ns1)
+		elem.text = distance
+		if last is not None:
+			elem.tail = trackpoint.tail
+			last.tail = trackpoint.text
+
+def rebased_distances(dist):
+	"""
+	DistanceMeters text for the kept points of a segment, counting from 0 at the segment's first point.
+	"""
+	if len(dist) == 0:
+		return []
+	texts = [str(round(d, 2)) for d in (dist - dist[0]).tolist()]
+	texts[0] = "0"
+	return texts
 
-			"""
-				#elem.attrib['xmlns'] = ns2
-				for node in elem.iter():
-					if node.tag == '{%s}Speed'%ns2:
-						speed_in_m_per_sec = float(node.text)
-						speed_km_per_h = speed_in_m_per_sec /1000.0 * 60 *60
-						power = s2p(speed_km_per_h, lever)
-						# add power to trackpoint
-						w = etree.SubElement(elem, '{%s}Watts'%ns2)
-						w.text = str(power)
-						w.tail = '\n'
-			"""
-	return returndict
-
-
-def update_lap(course, start_returndict, end_returndict):
-
-	startT = datetime.datetime.strptime(start_returndict["{%s}Time"%ns1], "%Y-%m-%dT%H:%M:%SZ")
-	endT = datetime.datetime.strptime(end_returndict["{%s}Time"%ns1], "%Y-%m-%dT%H:%M:%SZ")
-	deltaT = endT-startT
+def update_lap(course, points, kept):
+	"""
+	Set the course's Lap summary (time, distance, begin & end position) from the first & last kept points.
+	"""
+	first = kept[0]
+	last = kept[-1]
 	#As a rule we're chopping existing files into parts, and they have a running total of distance in each trackpoint
 	#So we can just subtract end-finish distance totals to get the total for our segmented file
-	#More accurate perhaps would be to calculate it via lat&long for each point
-	deltaD = str(round(float(end_returndict['{%s}DistanceMeters'%ns1]) - float(start_returndict['{%s}DistanceMeters'%ns1])))
+	#(with --distances compute that running total was calculated from lat & long)
+	deltaT = float(points['seconds'][last] - points['seconds'][first])
+	deltaD = str(round(float(points['dist'][last] - points['dist'][first])))
 
-	insertdict={} #start_returndict
-	insertdict[("{%s}TotalTimeSeconds"%ns1)] = str(deltaT.total_seconds()) #str(int(differenceT.total_seconds()))
+	insertdict={}
+	insertdict[("{%s}TotalTimeSeconds"%ns1)] = str(deltaT)
 	insertdict["{%s}DistanceMeters"%ns1] = deltaD
-	insertdict["{%s}BeginPosition/{%s}LatitudeDegrees"%(ns1,ns1)] = start_returndict["{%s}LatitudeDegrees"%ns1]
-	insertdict["{%s}BeginPosition/{%s}LongitudeDegrees"%(ns1,ns1)] = start_returndict["{%s}LongitudeDegrees"%ns1]
-	insertdict["{%s}EndPosition/{%s}LatitudeDegrees"%(ns1,ns1)] = end_returndict["{%s}LatitudeDegrees"%ns1]
-	insertdict["{%s}EndPosition/{%s}LongitudeDegrees"%(ns1,ns1)] = end_returndict["{%s}LongitudeDegrees"%ns1]
-	#insertdict = [("{%s}TotalTimeSeconds"%ns1) : '232', "{%s}TotalTimeSeconds"%ns1: '232', "{%s}BeginPosition/{%s}LatitudeDegrees"%(ns1,ns1): '232', "{%s}BeginPosition/{%s}LongitudeDegrees"%(ns1,ns1): '232', 
-	#		   "{%s}EndPosition/{%s}LatitudeDegrees"%(ns1,ns1): '232', "{%s}EndPosition/{%s}LongitudeDegrees"%(ns1,ns1): '232']
-
-	upsert_entry(course,1,insertdict,start_returndict, end_returndict)
+	insertdict["{%s}BeginPosition/{%s}LatitudeDegrees"%(ns1,ns1)] = str(float(points['lat'][first]))
+	insertdict["{%s}BeginPosition/{%s}LongitudeDegrees"%(ns1,ns1)] = str(float(points['lon'][first]))
+	insertdict["{%s}EndPosition/{%s}LatitudeDegrees"%(ns1,ns1)] = str(float(points['lat'][last]))
+	insertdict["{%s}EndPosition/{%s}LongitudeDegrees"%(ns1,ns1)] = str(float(points['lon'][last]))
+
+	upsert_entry(course,1,insertdict,{},{})
 	return
 
 def rename_courses_with_prefix(root, prefix):
+	"""
+	Put prefix at the start of each Course's Name and its Id in the Folders, trimmed to 15 characters.
+	"""
+	apply_rules(root, compile_rules(['prefixnames']), prefix)
 
-	nsmap = {
-    'ns1': ns1,
-    'ns2': ns2,
-	}
+'''
+Cleanup & renaming rules.  Each rule is an XPath (using ns1: for the TCX namespace) and what to do with the elements it finds:
+	'remove' takes them out of the file
+	'text' sets their text to function(text, setting)
+Course rules are applied to each Course in turn, with paths relative to the Course; file rules (renaming) to the whole file.
+The XPaths are compiled the first time a set of rules is used.
+'''
+rules = {}
+compiled_rules = {}
+user_rules = []
+rule_nsmap = {'ns1': ns1, 'ns2': ns2}
+note_bad_chars = re.compile('|'.join(re.escape(chars) for chars in ["\n", "\\p", "--"]))
 
-	
-	#These all work:  
-	#replace_first_chars_entry(root, ".//ns1:Id", prefix, nsmap)
-	#replace_first_chars_entry(root, ".//ns1:CourseNameRef/ns1:Id", prefix, nsmap)
-	#replace_first_chars_entry(root, ".//ns1:CourseFolder/ns1:CourseNameRef/ns1:Id", prefix, nsmap)
-	#replace_first_chars_entry(root, ".//ns1:CourseFolder[@*]/ns1:CourseNameRef/ns1:Id", prefix, nsmap)
-	#replace_first_chars_entry(root, ".//ns1:Folders/ns1:Courses/ns1:CourseFolder[@Name='Courses']/ns1:CourseNameRef/ns1:Id", prefix, nsmap)
-	#replace_first_chars_entry(root, ".//ns1:Folders/ns1:Courses/ns1:Course/ns1:Name", prefix, nsmap)
-	#replace_first_chars_entry(root, ".//ns1:Folders", prefix, nsmap)
-	#xpath=#$(*@#$)(*&@#$)(*&#@$)(*&W#$&@&&
-	
-	replace_first_chars_entry(root, ".//ns1:CourseFolder[@Name='Courses']/ns1:CourseNameRef/ns1:Id", prefix, nsmap)
-	replace_first_chars_entry(root, ".//ns1:Courses/ns1:Course/ns1:Name", prefix, nsmap)
+def register_rule(name, path, action, function=None):
+	"""
+	Add a cleanup rule, or replace the rule of that name.
+	"""
+	if action not in ('remove', 'text'):
+		raise ValueError("rule action must be 'remove' or 'text', not '%s'" % action)
+	rules[name] = {'path': path, 'action': action, 'function': function}
+	compiled_rules.clear()
+
+def compile_rules(names):
+	#The compiled XPath, action & function of each of these rules, in order
+	key = tuple(names)
+	if key not in compiled_rules:
+		compiled_rules[key] = [(etree.XPath(rules[name]['path'], namespaces=rule_nsmap), rules[name]['action'], rules[name]['function']) for name in names]
+	return compiled_rules[key]
+
+def apply_rules(root, compiled, setting=None):
+	for path, action, function in compiled:
+		#XPath returns a list, so elements can be removed as we go
+		for elem in path(root):
+			if action == 'remove':
+				elem.getparent().remove(elem)
+			else:
+				elem.text = function(elem.text, setting)
 
-	'''
-	    <Courses>
-      <CourseFolder Name="Courses">
-        <CourseNameRef>
-          <Id>SFE-03-01P-Sant</Id>
-'''
-	#adder = {'Name':prefix}
-	#replace_first_chars_entry(root, "/TrainingCenterDatabase/Courses/Course/Name", prefix)
+def trim_note(text, setting=None):
+	#Trim a Note to 32 characters and blank out anything that upsets some GPS units
+	text = text.strip()
+	text = (text[:30] + '..') if len(text) > 32 else text
+	return note_bad_chars.sub(' ', text)
 
-def cleanup_course(course, cleancourse, cleannotes, trimnotes):
-	#print ("Course cleanup . . . ")
-	bad_chars = ["\n", "\p", "--"]
-	for child in course:
-		
-		if child.tag == '{%s}CoursePoint'%ns1:
-			for elem in child.iter():
-				#remove all notes (for now, testing)
-				if cleannotes and elem.tag == '{%s}Notes'%ns1  and isinstance(elem.text, str):
-					#print ("Removing:", elem.text)
-					elem.text=""
-					child.remove(elem)  #remove it entirely
-				if trimnotes and elem.tag == '{%s}Notes'%ns1 and isinstance(elem.text, str):
-					#print ("Trimming:", elem.text)
-					elem.text=elem.text.strip()
-					elem.text = (elem.text[:30] + '..') if len(elem.text) > 32 else elem.text
-					#elem.text = filter(lambda i: i not in bad_chars, elem_text)
-					for i in bad_chars : 
-						elem.text = elem.text.replace(i, ' ') 
-					#print ("Trimmed:", elem.text)
+def prefix_name(text, prefix):
+	return (prefix + (text or ''))[:15] # trim to 15 chars
 
+register_rule('dropgeneric', "ns1:CoursePoint[ns1:PointType='Generic']", 'remove')
+register_rule('dropnotes', "ns1:CoursePoint/ns1:Notes[text()]", 'remove')
+register_rule('trimnotes', "ns1:CoursePoint/ns1:Notes[text()]", 'text', trim_note)
+register_rule('prefixnames', ".//ns1:CourseFolder[@Name='Courses']/ns1:CourseNameRef/ns1:Id | .//ns1:Courses/ns1:Course/ns1:Name", 'text', prefix_name)
 
+def load_rules_file(rulesfile):
+	"""
+	Register the rules in a JSON file of the form
+	    [{"name": "nodanger", "path": "ns1:CoursePoint[ns1:PointType='Danger']", "action": "remove"},
+	     {"name": "road", "path": "ns1:CoursePoint/ns1:Name", "action": "replace", "pattern": "Road", "replacement": "Rd"}]
+	("replace" is a regular expression substitution in the element's text), and return their names.  Any other action is a
+	ValueError: 'text' rules need a function, which a JSON file can't give.
+	"""
+	with open(rulesfile) as f:
+		entries = json.load(f)
+	names = []
+	for entry in entries:
+		if entry.get('action') == 'replace':
+			function = (lambda pattern, replacement: lambda text, setting: pattern.sub(replacement, text or ''))(re.compile(entry['pattern']), entry.get('replacement', ''))
+			register_rule(entry['name'], entry['path'], 'text', function)
+		elif entry.get('action') == 'remove':
+			register_rule(entry['name'], entry['path'], 'remove')
+		else:
+			raise ValueError("rule '%s': action must be 'remove' or 'replace', not '%s'" % (entry.get('name'), entry.get('action')))
+		rules[entry['name']]['source'] = json.dumps(entry, sort_keys=True) #the function can't be compared; --delta compares this
+		names.append(entry['name'])
+	compile_rules(names)
+	return names
+
+def cleanup_course(course, cleancourse, cleannotes, trimnotes):
+	"""
+	Apply the cleanup rules chosen by the options, then any --rules, to one Course.
+	"""
+	names = [name for name, chosen in (('dropgeneric', cleancourse), ('dropnotes', cleannotes), ('trimnotes', trimnotes)) if chosen]
+	apply_rules(course, compile_rules(names + user_rules))
 
-				#remove any generic CoursePoints, may cause problems
-				if cleancourse and elem.tag == '{%s}PointType'%ns1 and elem.text == "Generic":
-					#print ("Deleting:", elem.text)
-					child.getparent().remove(child)
 
 
+def track_window(points, times, startT, endT):
+	#A Track's points (its arrays from route_tracks) in a segment's time window: their indexes, and which are at its turns (pinned)
+	idx = np.flatnonzero((points['seconds'] >= startT) & (points['seconds'] <= endT))
+	return idx, np.isin(points['time'][idx], times)
 
-def process_track(course, track, percent, times, start_time, end_time):
+def process_track(course, track, points, idx, pinned, budget, rng):
 	"""
-	Process a TCX file track element.
+	Process a TCX file track element: fill the (emptied) track with copies of budget of the Trackpoints in its window
+	(idx & pinned from track_window) of points, its arrays from route_tracks.
+	With --fidelity, returns the segment's points & which of them were kept, for add_fidelity (outside the prune stage).
 	"""
+	global num_window_trackpoints
 
 	'''
 	   <Lap>
@@ -701,107 +1484,632 @@ def process_track(course, track, percent, times, start_time, end_time):
       </Lap>
 
 	  '''
-	first = True
-	start_returndict = {}
-	end_returndict = {}
-	#make sure we have something at least reasonably sensible in these dictionaries as there is a chance they won't ever be updated if the file is corrupted or something
-	start_returndict[("{%s}TotalTimeSeconds"%ns1)] = "0"
-	start_returndict["{%s}DistanceMeters"%ns1] = "0"
-	start_returndict["{%s}BeginPosition/{%s}LatitudeDegrees"%(ns1,ns1)] = "0"
-	start_returndict["{%s}BeginPosition/{%s}LongitudeDegrees"%(ns1,ns1)] = "0"
-	start_returndict["{%s}EndPosition/{%s}LatitudeDegrees"%(ns1,ns1)] = "0"
-	start_returndict["{%s}EndPosition/{%s}LongitudeDegrees"%(ns1,ns1)] = "0"
-	end_returndict = start_returndict
-
-	startT = datetime.datetime.strptime(start_time, "%Y-%m-%dT%H:%M:%SZ")
-	endT = datetime.datetime.strptime(end_time, "%Y-%m-%dT%H:%M:%SZ")
+	#Only Trackpoints within this segment's time window survive; Trackpoints at CoursePoints are pinned
+	window = select_points(points, idx)
+	num_window_trackpoints += len(idx)
+	keep = np.zeros(len(points['seconds']), dtype=bool)
+	keep[idx] = turn_keep_mask(window, pinned, budget, rng)
+	if measure_error:
+		deviation = dropped_deviation(window['lat'], window['lon'], keep[idx])
+		if len(deviation):
+			route_error['max'] = max(route_error['max'], float(deviation.max()))
+			route_error['sum'] += float(deviation.sum())
+			route_error['count'] += len(deviation)
+	measured = (window, keep[idx]) if fidelity else None
+
+	kept = np.flatnonzero(keep)
+	for i, distance in zip(kept.tolist(), rebased_distances(points['dist'][kept])):
+		#Each keeps its own tail, so the indenting comes out as if the others had been removed around it
+		trackpoint = copy.deepcopy(points['trackpoints'][i])
+		track.append(trackpoint)
+		process_trackpoint(track, trackpoint, distance)
+	if len(kept):
+		update_lap(course, points, kept)
+	return measured
 
-	for child in track:
-		#print (child.tag)
-		if child.tag == '{%s}Trackpoint'%ns1:
-			#print ('working')
-			returndict = process_trackpoint(track, child, percent, times, startT, endT, start_returndict["{%s}DistanceMeters"%ns1], first )
-			#print (returndict)
-			if (returndict != {} and first):
-				start_returndict = returndict
-				first = False
-			if (returndict != {}):end_returndict = returndict
-	update_lap(course, start_returndict, end_returndict)
 
 
-def process_file(tree, root, tcxfile, num_parts, percent, first, last, cleancourse, cleannotes, trimnotes, prnt, prefix_number):
+'''
+FIT course output (--format fit).  A FIT file is a 14 byte header, a stream of messages and a CRC of everything before it.
+Each kind of message is described once by a definition message (its global message number & fields) under a local
+number 0-15; data messages then carry just that local number and the field values.
+'''
+fit_epoch = 631065600 #1989-12-31T00:00:00Z, where FIT time starts, as a Unix time
+fit_semicircles = 2**31 / 180.0
+#Field formats are struct formats, except 'u': a uint8, packed as 'B' but declared as uint8 where 'B' is an enum
+fit_invalid = {'B': 0xFF, 'u': 0xFF, 'H': 0xFFFF, 'I': 0xFFFFFFFF, 'i': 0x7FFFFFFF}
+fit_base_types = {'B': 0x00, 'u': 0x02, 'H': 0x84, 'I': 0x86, 'i': 0x85, 's': 0x07}
+
+#name: (global message number, [(field name, field number, struct format)]), in the order the messages are defined
+fit_messages = {
+	'file_id': (0, [('type', 0, 'B'), ('manufacturer', 1, 'H'), ('product', 2, 'H'), ('time_created', 4, 'I')]),
+	'course': (31, [('sport', 4, 'B'), ('name', 5, '16s')]),
+	'lap': (19, [('timestamp', 253, 'I'), ('start_time', 2, 'I'), ('start_position_lat', 3, 'i'), ('start_position_long', 4, 'i'),
+			('end_position_lat', 5, 'i'), ('end_position_long', 6, 'i'), ('total_elapsed_time', 7, 'I'), ('total_timer_time', 8, 'I'),
+			('total_distance', 9, 'I')]),
+	'event': (21, [('timestamp', 253, 'I'), ('event', 0, 'B'), ('event_type', 1, 'B'), ('event_group', 4, 'u')]),
+	'record': (20, [('timestamp', 253, 'I'), ('position_lat', 0, 'i'), ('position_long', 1, 'i'), ('distance', 5, 'I')]),
+	'course_point': (32, [('message_index', 254, 'H'), ('timestamp', 1, 'I'), ('position_lat', 2, 'i'), ('position_long', 3, 'i'),
+			('distance', 4, 'I'), ('type', 5, 'B'), ('name', 6, '16s')]),
+}
+#The CoursePoint PointTypes of a TCX file, numbered as FIT numbers them
+fit_point_types = {name: number for number, name in enumerate(['Generic', 'Summit', 'Valley', 'Water', 'Food', 'Danger', 'Left', 'Right', 'Straight',
+	'First Aid', '4th Category', '3rd Category', '2nd Category', '1st Category', 'Hors Category', 'Sprint'])}
+
+def fit_crc_table():
+	#CRC-16 (polynomial 0xA001, as FIT uses) of every byte value
+	table = []
+	for byte in range(256):
+		crc = byte
+		for bit in range(8):
+			crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+		table.append(crc)
+	return table
+
+fit_crc_values = fit_crc_table()
+
+def fit_crc(crc, data):
+	for byte in data:
+		crc = (crc >> 8) ^ fit_crc_values[(crc ^ byte) & 0xFF]
+	return crc
+
+def fit_structs():
+	#Definition message bytes & data message Struct for each message, local message numbers in fit_messages order
+	structs = {}
+	for local, (name, (number, fields)) in enumerate(fit_messages.items()):
+		definition = struct.pack('<BBBHB', 0x40 | local, 0, 0, number, len(fields))
+		for field, field_number, fmt in fields:
+			size = struct.calcsize('<' + fmt.replace('u', 'B'))
+			definition += struct.pack('<BBB', field_number, size, fit_base_types[fmt[-1]])
+		structs[name] = (definition, local, struct.Struct('<B' + ''.join(fmt.replace('u', 'B') for field, field_number, fmt in fields)))
+	return structs
+
+fit_message_structs = fit_structs()
+
+def fit_value(value, fmt, scale=1):
+	#A field value in FIT units, or the field's invalid value if we don't have one
+	if value is None or (isinstance(value, float) and math.isnan(value)):
+		return fit_invalid[fmt]
+	return int(round(value * scale))
+
+@contextmanager
+def open_output(target, mode):
+	#An output file to write, by name--or a binary file object already open (--out-tar builds each file in memory)
+	if isinstance(target, str):
+		with open(target, mode, **({} if 'b' in mode else {'encoding': 'utf-8', 'newline': '\n'})) as out:
+			yield out
+	elif 'b' in mode:
+		yield target
+	else:
+		out = TextIOWrapper(target, encoding='utf-8', newline='\n')
+		try:
+			yield out
+		finally:
+			out.flush()
+			out.detach()
+
+def add_to_archive(name, data):
+	#Add a finished output file to out_archive; a tar is pushed down the stream straight away
+	if isinstance(out_archive, zipfile.ZipFile):
+		out_archive.writestr(os.path.basename(name), data)
+	else:
+		info = tarfile.TarInfo(os.path.basename(name))
+		info.size = len(data)
+		info.mtime = int(time.time())
+		info.mode = 0o644
+		out_archive.addfile(info, BytesIO(data))
+		out_archive_file.flush()
+	output_sizes[name] = len(data)
+
+def serve_download(name, data):
 	"""
-	Process the whole TCX file.
+	Web GUI: offer data (the zip of a run's output files) for download from memory at download_host:download_port/name.
+	The server starts with the first run, in a thread of its own, and serves whichever run finished last.  Raises
+	OSError if the port can't be had.  Only a browser on this machine can use the link: the zip is saved too (save_download).
 	"""
-	global num_coursepoints, num_trackpoints, num_tracks, num_courses, prefix, gui, progress_window, mystdout
-	
-
-	for element in root.iter():
-		if element.tag == '{%s}Course'%ns1:
-			num_courses += 1
-			#print (element)
-			#print (element.tag)
-			#print ('\n')
-			times = []
-			times_elem = element.findall('{%s}CoursePoint/{%s}Time'% (ns1,ns1))
-			times_count=0
-			times_included_count = 0
-			start_time = ""
-			end_time = ""
-			times_first = True
-
+	global download_server
+	download['name'] = name
+	download['data'] = data
+	if download_server is None:
+		class DownloadHandler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				self.send_response(200)
+				self.send_header('Content-Type', 'application/zip')
+				self.send_header('Content-Disposition', 'attachment; filename="%s"' % download['name'])
+				self.send_header('Content-Length', str(len(download['data'])))
+				self.end_headers()
+				self.wfile.write(download['data'])
+			def log_message(self, *args):
+				pass
+		download_server = http.server.ThreadingHTTPServer((download_host, download_port), DownloadHandler)
+		threading.Thread(target=download_server.serve_forever, daemon=True).start()
+	return "http://%s:%s/%s" % (download_host, download_port, name)
+
+def save_download(inputfilename, name, data):
+	#Web GUI: write the zip next to the input file.  The browser may well be on another device (the web GUI is reached from
+	#anywhere on the network, or through the Repl.it page) where serve_download's link can't be reached.
+	zipname = os.path.join(os.path.dirname(inputfilename), name)
+	with open(zipname, 'wb') as f:
+		f.write(data)
+	return zipname
+
+def output_size(name):
+	#Size of an output file, on disk or in the tar
+	return output_sizes[name] if name in output_sizes else os.path.getsize(name)
+
+def write_fit(fitfile, root, chunk=1000):
+	"""
+	Write the (first) Course in root as a FIT course file: file_id, course, lap & start event, then a record for each
+	kept Trackpoint, the stop event and a course_point for each CoursePoint.  Every message has a fixed size, so the
+	data size in the header is known up front and the file is written (and its CRC calculated) a chunk at a time.
+	"""
+	course = root.find('{%s}Courses/{%s}Course'%(ns1,ns1))
+	tracks = [track_arrays(track) for track in course.findall('{%s}Track'%ns1)]
+	seconds = np.concatenate([points['seconds'] for points in tracks] + [np.zeros(0, dtype=np.int64)])
+	lat = np.concatenate([points['lat'] for points in tracks] + [np.zeros(0)])
+	lon = np.concatenate([points['lon'] for points in tracks] + [np.zeros(0)])
+	dist = np.concatenate([points['dist'] for points in tracks] + [np.zeros(0)])
+	if len(dist):
+		dist = dist - dist[0]
+
+	coursepoints = []
+	for coursepoint in course.findall('{%s}CoursePoint'%ns1):
+		when = time_seconds([coursepoint.findtext('{%s}Time'%ns1) or '1989-12-31T00:00:00'])[0]
+		i = min(np.searchsorted(seconds, when), len(seconds) - 1) if len(seconds) else -1
+		coursepoints.append((when, float(coursepoint.findtext('{%s}Position/{%s}LatitudeDegrees'%(ns1,ns1)) or 'nan'),
+			float(coursepoint.findtext('{%s}Position/{%s}LongitudeDegrees'%(ns1,ns1)) or 'nan'), float(dist[i]) if i >= 0 else None,
+			fit_point_types.get(coursepoint.findtext('{%s}PointType'%ns1), 0), (coursepoint.findtext('{%s}Name'%ns1) or '').encode('utf-8')[:15]))
+
+	start = int(seconds[0]) - fit_epoch if len(seconds) else 0
+	end = int(seconds[-1]) - fit_epoch if len(seconds) else 0
+	first = (float(lat[0]), float(lon[0])) if len(lat) else (None, None)
+	last = (float(lat[-1]), float(lon[-1])) if len(lat) else (None, None)
+	elapsed = end - start
+	total = float(dist[-1]) if len(dist) else 0.0
+	name = (course.findtext('{%s}Name'%ns1) or '').encode('utf-8')[:15]
+	messages = [('file_id', (6, 255, 0, start)), ('course', (2, name)),
+		('lap', (end, start, fit_value(first[0], 'i', fit_semicircles), fit_value(first[1], 'i', fit_semicircles), fit_value(last[0], 'i', fit_semicircles),
+			fit_value(last[1], 'i', fit_semicircles), elapsed * 1000, elapsed * 1000, fit_value(total, 'I', 100))),
+		('event', (start, 0, 0, 0))]
+	closing = [('event', (end, 0, 4, 0))] + [('course_point', (i, when - fit_epoch, fit_value(cp_lat, 'i', fit_semicircles), fit_value(cp_lon, 'i', fit_semicircles),
+		fit_value(cp_dist, 'I', 100), point_type, cp_name)) for i, (when, cp_lat, cp_lon, cp_dist, point_type, cp_name) in enumerate(coursepoints)]
+
+	#Records go straight from the arrays to bytes
+	record_dtype = np.dtype([('header', '<u1'), ('timestamp', '<u4'), ('position_lat', '<i4'), ('position_long', '<i4'), ('distance', '<u4')])
+	records = np.zeros(len(seconds), dtype=record_dtype)
+	records['header'] = fit_message_structs['record'][1]
+	records['timestamp'] = seconds - fit_epoch
+	for field, values in (('position_lat', lat), ('position_long', lon)):
+		records[field] = np.where(np.isnan(values), fit_invalid['i'], np.round(np.nan_to_num(values) * fit_semicircles)).astype(np.int64)
+	records['distance'] = np.where(np.isnan(dist), fit_invalid['I'], np.round(np.nan_to_num(dist) * 100)).astype(np.int64)
+
+	used = set(name for name, values in messages + closing) | {'record'}
+	definitions = b''.join(fit_message_structs[name][0] for name in fit_messages if name in used)
+	data_size = len(definitions) + sum(fit_message_structs[name][2].size for name, values in messages + closing) + records.nbytes
+	header = struct.pack('<BBHI4s', 14, 0x20, 2132, data_size, b'.FIT')
+	header += struct.pack('<H', fit_crc(0, header))
+
+	with open_output(fitfile, 'wb') as out:
+		crc = 0
+		for block in [header, definitions, b''.join(fit_message_structs[name][2].pack(fit_message_structs[name][1], *values) for name, values in messages)]:
+			out.write(block)
+			crc = fit_crc(crc, block)
+		for i in range(0, len(records), chunk):
+			block = records[i:i + chunk].tobytes()
+			out.write(block)
+			crc = fit_crc(crc, block)
+		for i in range(0, len(closing), chunk):
+			block = b''.join(fit_message_structs[name][2].pack(fit_message_structs[name][1], *values) for name, values in closing[i:i + chunk])
+			out.write(block)
+			crc = fit_crc(crc, block)
+		out.write(struct.pack('<H', crc))
+
+
+gpx_ns = 'http://www.topografix.com/GPX/1/1'
+gpx_speed = 20 / 3.6 #m/s, for timing GPX routes that have no times of their own
+
+def memo_get(kind, key):
+	#The result stored for kind & key by an earlier run (with memoize on), or None
+	if not memoize:
+		return None
+	value = stage_memo.pop((kind, key), None)
+	if value is not None:
+		stage_memo[(kind, key)] = value #most recently used goes last, so it is evicted last
+	return value
+
+def memo_put(kind, key, value):
+	#Keep value for kind & key, dropping the least recently used results past memo_limit
+	if not memoize:
+		return
+	stage_memo[(kind, key)] = value
+	while len(stage_memo) > memo_limit:
+		del stage_memo[next(iter(stage_memo))]
+
+def read_route(inputfilename):
+	#The input file as a TCX tree; with memoize on, the same tree as last time if the file has not changed since
+	if not memoize or inputfilename == '-':
+		return parse_route(inputfilename)
+	info = os.stat(inputfilename)
+	key = (os.path.abspath(inputfilename), info.st_size, info.st_mtime_ns)
+	tree = memo_get('parse', key)
+	if tree is not None:
+		print ("Reusing %s as read for the last run (unchanged since)" % os.path.basename(inputfilename))
+		return tree
+	#A different (or changed) file: nothing stored for the old one can be used again
+	stage_memo.clear()
+	tree = parse_route(inputfilename)
+	memo_put('parse', key, tree)
+	return tree
+
+def parse_route(inputfilename):
+	#The input file as a TCX tree, whether it is .tcx or .gpx (- reads .tcx from stdin)
+	if inputfilename.lower().endswith('.gpx'):
+		return read_gpx(inputfilename)
+	tree = etree.parse(sys.stdin.buffer if inputfilename == '-' else inputfilename)
+	snapped = snap_coursepoints(tree.getroot())
+	if snapped:
+		print ("%s CoursePoints had no matching Trackpoint Time and were snapped to the nearest Trackpoint" % snapped)
+	return tree
+
+def read_gpx(gpxfile):
+	"""
+	Read a GPX file (1.0 or 1.1) straight into the TCX tree the rest of VPrune works on, in one streaming pass.
+	Each trk (all its trksegs) or rte becomes a Course, its trkpts/rtepts the Course's Trackpoints, and each wpt (turn cue
+	or other waypoint) a CoursePoint at the nearest Trackpoint of the nearest Course.  Routes without times (or with
+	times out of order) are timed at gpx_speed along the route.
+	"""
+	routes = []
+	waypoints = []
+	current = None
+	for event, elem in etree.iterparse(gpxfile, events=('start', 'end'), remove_comments=True):
+		tag = etree.QName(elem).localname
+		if event == 'start':
+			if tag in ('trk', 'rte'):
+				current = {'name': '', 'lat': [], 'lon': [], 'ele': [], 'time': []}
+				routes.append(current)
+			continue
+		if tag in ('trkpt', 'rtept') and current is not None:
+			current['lat'].append(float(elem.get('lat')))
+			current['lon'].append(float(elem.get('lon')))
+			current['ele'].append(elem.findtext('{*}ele'))
+			current['time'].append(elem.findtext('{*}time'))
+		elif tag == 'wpt':
+			point_type = (elem.findtext('{*}type') or elem.findtext('{*}sym') or '').strip().title()
+			waypoints.append({'lat': float(elem.get('lat')), 'lon': float(elem.get('lon')), 'name': (elem.findtext('{*}name') or '').strip(),
+				'notes': (elem.findtext('{*}desc') or elem.findtext('{*}cmt') or '').strip(), 'type': point_type if point_type in fit_point_types else 'Generic'})
+		elif tag == 'name' and current is not None and etree.QName(elem.getparent()).localname in ('trk', 'rte'):
+			current['name'] = (elem.text or '').strip()
+			continue
+		else:
+			continue
+		#Done with this point: free it, and anything before it
+		elem.clear()
+		while elem.getprevious() is not None:
+			del elem.getparent()[0]
+	routes = [route for route in routes if route['lat']]
+	if not routes:
+		raise ValueError("no trk or rte points in %s" % gpxfile)
+
+	root = etree.Element('{%s}TrainingCenterDatabase'%ns1, nsmap={None: ns1, 'xsi': 'http://www.w3.org/2001/XMLSchema-instance'})
+	root.set('{http://www.w3.org/2001/XMLSchema-instance}schemaLocation', ns1 + ' http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd')
+	folder = etree.SubElement(etree.SubElement(etree.SubElement(root, '{%s}Folders'%ns1), '{%s}Courses'%ns1), '{%s}CourseFolder'%ns1, Name='Courses')
+	courses = etree.SubElement(root, '{%s}Courses'%ns1)
+	base = os.path.splitext(os.path.basename(gpxfile))[0]
+	arrays = []
+	for number, route in enumerate(routes):
+		lat = np.array(route['lat'])
+		lon = np.array(route['lon'])
+		dist = route_distances(lat, lon)
+		seconds = gpx_seconds(route['time'], dist)
+		times = np.datetime_as_string(seconds.astype('datetime64[s]')).astype(object) + 'Z'
+		arrays.append((lat, lon, times))
+		name = (route['name'] or base if len(routes) == 1 else "%s %i" % (route['name'] or base, number + 1))[:15]
+		etree.SubElement(etree.SubElement(folder, '{%s}CourseNameRef'%ns1), '{%s}Id'%ns1).text = name
+		course = etree.SubElement(courses, '{%s}Course'%ns1)
+		etree.SubElement(course, '{%s}Name'%ns1).text = name
+		lap = etree.SubElement(course, '{%s}Lap'%ns1)
+		etree.SubElement(lap, '{%s}TotalTimeSeconds'%ns1).text = str(int(seconds[-1] - seconds[0]))
+		etree.SubElement(lap, '{%s}DistanceMeters'%ns1).text = str(round(float(dist[-1]), 1))
+		for position, i in (('BeginPosition', 0), ('EndPosition', -1)):
+			elem = etree.SubElement(lap, '{%s}%s'%(ns1, position))
+			etree.SubElement(elem, '{%s}LatitudeDegrees'%ns1).text = str(lat[i])
+			etree.SubElement(elem, '{%s}LongitudeDegrees'%ns1).text = str(lon[i])
+		etree.SubElement(lap, '{%s}Intensity'%ns1).text = 'Active'
+		track = etree.SubElement(course, '{%s}Track'%ns1)
+		for i in range(len(lat)):
+			trackpoint = etree.SubElement(track, '{%s}Trackpoint'%ns1)
+			etree.SubElement(trackpoint, '{%s}Time'%ns1).text = times[i]
+			position = etree.SubElement(trackpoint, '{%s}Position'%ns1)
+			etree.SubElement(position, '{%s}LatitudeDegrees'%ns1).text = str(route['lat'][i])
+			etree.SubElement(position, '{%s}LongitudeDegrees'%ns1).text = str(route['lon'][i])
+			if route['ele'][i]:
+				etree.SubElement(trackpoint, '{%s}AltitudeMeters'%ns1).text = route['ele'][i].strip()
+			etree.SubElement(trackpoint, '{%s}DistanceMeters'%ns1).text = str(round(float(dist[i]), 3))
+
+	#Waypoints become CoursePoints, in order along each Course
+	cues = []
+	offsets = np.cumsum([0] + [len(lat) for lat, lon, times in arrays])
+	grid = grid_index(np.concatenate([lat for lat, lon, times in arrays]), np.concatenate([lon for lat, lon, times in arrays]))
+	for waypoint in waypoints:
+		nearest = grid_nearest(grid, waypoint['lat'], waypoint['lon'])
+		course_number = int(np.searchsorted(offsets, nearest, 'right')) - 1
+		cues.append((course_number, nearest - int(offsets[course_number]), waypoint))
+	cues.sort(key=lambda cue: (cue[0], cue[1]))
+	for course_number, i, waypoint in cues:
+		coursepoint = etree.SubElement(courses[course_number], '{%s}CoursePoint'%ns1)
+		etree.SubElement(coursepoint, '{%s}Name'%ns1).text = (waypoint['name'] or waypoint['type'])[:10]
+		etree.SubElement(coursepoint, '{%s}Time'%ns1).text = arrays[course_number][2][i]
+		position = etree.SubElement(coursepoint, '{%s}Position'%ns1)
+		etree.SubElement(position, '{%s}LatitudeDegrees'%ns1).text = str(waypoint['lat'])
+		etree.SubElement(position, '{%s}LongitudeDegrees'%ns1).text = str(waypoint['lon'])
+		etree.SubElement(coursepoint, '{%s}PointType'%ns1).text = waypoint['type']
+		if waypoint['notes']:
+			etree.SubElement(coursepoint, '{%s}Notes'%ns1).text = waypoint['notes']
+	if hasattr(etree, 'indent'):
+		etree.indent(root, space='  ')
+	else:
+		indent_tree(root)
+	return etree.ElementTree(root)
+
+def gpx_seconds(times, dist):
+	#Unix times of a GPX route's points: its own, if every point has one and they go forward, else gpx_speed along the route
+	if all(times):
+		seconds = time_seconds(times)
+		if np.all(np.diff(seconds) > 0):
+			return seconds
+	start = time_seconds([times[0]])[0] if times[0] else time_seconds(['2000-01-01T00:00:00'])[0]
+	seconds = np.round(dist / gpx_speed).astype(np.int64)
+	#At least a second apart, as CoursePoints find their Trackpoints by time
+	steps = np.arange(len(seconds))
+	return start + np.maximum.accumulate(seconds - steps) + steps
+
+def indent_tree(elem, level=0):
+	#Pretty-print indenting, for lxml versions before etree.indent
+	if len(elem):
+		elem.text = "\n" + "  " * (level + 1)
+		for child in elem:
+			indent_tree(child, level + 1)
+			child.tail = "\n" + "  " * (level + 1)
+		child.tail = "\n" + "  " * level
+
+def write_gpx(gpxfile, root, chunk=10000):
+	"""
+	Write the Courses in root as GPX 1.1, streamed a chunk at a time: a wpt for each CoursePoint, then a trk for each Course.
+	Trackpoints keep their altitude as ele (--compact has already dropped it).  GPX points must have a lat & lon, so
+	Trackpoints & CoursePoints without a Position are left out.
+	"""
+	courses = root.findall('{%s}Courses/{%s}Course'%(ns1,ns1))
+	with open_output(gpxfile, 'w') as out:
+		out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+		out.write('<gpx version="1.1" creator="VPrune" xmlns="%s" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="%s http://www.topografix.com/GPX/1/1/gpx.xsd">\n' % (gpx_ns, gpx_ns))
+		for course in courses:
+			for coursepoint in course.findall('{%s}CoursePoint'%ns1):
+				lat = coursepoint.findtext('{%s}Position/{%s}LatitudeDegrees'%(ns1,ns1))
+				lon = coursepoint.findtext('{%s}Position/{%s}LongitudeDegrees'%(ns1,ns1))
+				if not lat or not lon:
+					continue
+				out.write('  <wpt lat="%s" lon="%s">\n' % (lat, lon))
+				for tcx_tag, gpx_tag in (('Time', 'time'), ('Name', 'name'), ('Notes', 'desc'), ('PointType', 'type')):
+					text = coursepoint.findtext('{%s}%s'%(ns1, tcx_tag))
+					if text:
+						out.write('    <%s>%s</%s>\n' % (gpx_tag, html.escape(text, quote=False), gpx_tag))
+				out.write('  </wpt>\n')
+		for course in courses:
+			out.write('  <trk>\n    <name>%s</name>\n' % html.escape(course.findtext('{%s}Name'%ns1) or '', quote=False))
+			for track in course.findall('{%s}Track'%ns1):
+				points = track_arrays(track)
+				points = select_points(points, np.flatnonzero(~np.isnan(points['lat']) & ~np.isnan(points['lon'])))
+				elevations = ['<ele>%s</ele>' % ele if ele else '' for ele in (trackpoint.findtext('{%s}AltitudeMeters'%ns1) for trackpoint in points['trackpoints'])]
+				out.write('    <trkseg>\n')
+				for first in range(0, len(points['time']), chunk):
+					out.write(''.join(['      <trkpt lat="%r" lon="%r">%s<time>%s</time></trkpt>\n' % row for row in
+						zip(points['lat'][first:first + chunk].tolist(), points['lon'][first:first + chunk].tolist(), elevations[first:first + chunk], points['time'][first:first + chunk].tolist())]))
+				out.write('    </trkseg>\n')
+			out.write('  </trk>\n')
+		out.write('</gpx>\n')
+
+compact_drop = set('{%s}%s'%(ns1, tag) for tag in ['Extensions', 'AltitudeMeters', 'HeartRateBpm', 'Cadence', 'SensorState',
+	'BeginAltitude', 'EndAltitude', 'AverageHeartRateBpm', 'MaximumHeartRateBpm'])
+
+def compact_tree(root, decimals):
+	"""
+	--compact, in one pass over the tree: strip the indenting, round latitude & longitude to decimals places and distances &
+	times to whole numbers, and drop what a GPS unit doesn't need to follow the course--altitude, heart rate & cadence,
+	extensions, empty Notes, comments and the schema location.
+	Returns the number of bytes this takes off the file as written (as .tcx), counted as it goes rather than by writing it twice.
+	"""
+	latlon = ('{%s}LatitudeDegrees'%ns1, '{%s}LongitudeDegrees'%ns1)
+	whole = ('{%s}DistanceMeters'%ns1, '{%s}TotalTimeSeconds'%ns1)
+	notes = '{%s}Notes'%ns1
+	drop = []
+	saved = 0
+	for elem in root.iter():
+		if elem.tail is not None and not elem.tail.strip():
+			saved += len(elem.tail)
+			elem.tail = None
+		if not isinstance(elem.tag, str) or elem.tag in compact_drop or (elem.tag == notes and not (elem.text or '').strip()):
+			drop.append(elem)
+		elif len(elem):
+			if elem.text is not None and not elem.text.strip():
+				saved += len(elem.text)
+				elem.text = None
+		elif elem.tag in latlon and elem.text:
+			text = str(round(float(elem.text), decimals))
+			saved += len(elem.text) - len(text)
+			elem.text = text
+		elif elem.tag in whole and elem.text:
+			text = str(int(round(float(elem.text))))
+			saved += len(elem.text) - len(text)
+			elem.text = text
+	for elem in drop:
+		#Written on its own, an element declares the namespaces it is in; in the file they are declared once, at the root
+		saved += len(etree.tostring(elem, with_tail=False)) - namespace_bytes(elem.nsmap if isinstance(elem.tag, str) else {})
+		elem.getparent().remove(elem)
+	location = root.attrib.pop('{http://www.w3.org/2001/XMLSchema-instance}schemaLocation', None)
+	if location is not None:
+		saved += len(' xsi:schemaLocation=""') + len(html.escape(location))
+	declared = namespace_bytes(root.nsmap)
+	etree.cleanup_namespaces(root)
+	return saved + declared - namespace_bytes(root.nsmap)
+
+def namespace_bytes(nsmap):
+	#Length of the xmlns declarations of these namespaces
+	return sum(len(' xmlns%s="%s"' % (':' + prefix if prefix else '', uri)) for prefix, uri in nsmap.items())
+
+def prune_file(root, percent, first, last, maxpoints, course_tracks, rng):
+	"""
+	Keep only turns first to last of each Course & prune its Tracks, sharing the file's Trackpoint budget among them.  root is a
+	copy of route_tracks' skeleton, course_tracks its Tracks' points and rng the file's random generator.
+	"""
+	global num_coursepoints, num_tracks, num_courses
+
+	for number, element in enumerate(root.iter('{%s}Course'%ns1)):
+		num_courses += 1
+		#print (element)
+		#print (element.tag)
+		#print ('\n')
+		times = []
+		times_elem = element.findall('{%s}CoursePoint/{%s}Time'% (ns1,ns1))
+		times_count=0
+		times_included_count = 0
+		start_time = ""
+		end_time = ""
+		times_first = True
+
+		with stage('segment'):
 			for elem in times_elem:
-					#print(elem.text)
-					times_count += 1
-					if (times_count >= first and times_count <= last):
-						if (times_first):
-							start_time = elem.text
-						times.append(elem.text)
-						end_time = elem.text
-						times_included_count += 1
-						times_first = False
-					else:
-						#remove all course points not within the given range
-						elem.getparent().getparent().remove(elem.getparent())
-
-			#print (times)
-
-			num_coursepoints += times_included_count
-
-			tracks = []
-
-			for element2 in element.iter():
-				#print (element2.tag)
-				#print ('element2 \n')
-				if element2.tag == '{%s}Track'%ns1:
-					tracks.append(element2)	
-					#print ('appended track \n')
-														
-			num_tracks += len(tracks)
-			for track in tracks:
-				#print ('processing track \n')
-				process_track(element, track, percent, times, start_time, end_time)
-				#update_lap(track)
-		
-			if cleancourse or cleannotes or trimnotes:
+				#print(elem.text)
+				times_count += 1
+				if (times_count >= first and times_count <= last):
+					if (times_first):
+						start_time = elem.text
+					times.append(elem.text)
+					end_time = elem.text
+					times_included_count += 1
+					times_first = False
+				else:
+					#remove all course points not within the given range
+					elem.getparent().getparent().remove(elem.getparent())
+
+		#print (times)
+
+		num_coursepoints += times_included_count
+
+		tracks = []
+
+		for element2 in element.iter('{%s}Track'%ns1):
+			tracks.append(element2)	
+			#print ('appended track \n')
+													
+		num_tracks += len(tracks)
+		with stage('prune'):
+			startT, endT = time_seconds([start_time, end_time])
+			windows = [track_window(points, times, startT, endT) for points in course_tracks[number]]
+			budgets = track_budgets([pinned for idx, pinned in windows], percent, maxpoints)
+		for track, points, (idx, pinned), budget in zip(tracks, course_tracks[number], windows, budgets):
+			#print ('processing track \n')
+			with stage('prune'):
+				measured = process_track(element, track, points, idx, pinned, budget, rng)
+			if measured is not None:
+				with stage('fidelity'):
+					add_fidelity(*measured)
+			#update_lap(track)
+
+def segment_counters():
+	#The run's counters that pruning one file adds to
+	return {'courses': num_courses, 'tracks': num_tracks, 'trackpoints': num_trackpoints, 'coursepoints': num_coursepoints,
+			'window_trackpoints': num_window_trackpoints, 'route_error': dict(route_error)}
+
+def counter_changes(before):
+	#What pruning one file added to the counters since before = segment_counters(), to replay when the file is reused
+	after = segment_counters()
+	changes = {name: after[name] - before[name] for name in before if name != 'route_error'}
+	changes['route_error'] = {name: value - before['route_error'].get(name, 0) for name, value in after['route_error'].items() if name != 'max'}
+	changes['route_error_max'] = after['route_error'].get('max', 0.0)
+	changes['fidelity_stats'] = dict(fidelity_stats)
+	return changes
+
+def replay_counter_changes(changes):
+	#Add what pruning a reused file added to the counters, as if it had been pruned again
+	global num_courses, num_tracks, num_trackpoints, num_coursepoints, num_window_trackpoints, fidelity_stats
+	num_courses += changes['courses']
+	num_tracks += changes['tracks']
+	num_trackpoints += changes['trackpoints']
+	num_coursepoints += changes['coursepoints']
+	num_window_trackpoints += changes['window_trackpoints']
+	for name, value in changes['route_error'].items():
+		route_error[name] = route_error.get(name, 0) + value
+	if 'max' in route_error:
+		route_error['max'] = max(route_error['max'], changes['route_error_max'])
+	fidelity_stats = dict(changes['fidelity_stats'])
+
+def cleanup_key(cleancourse, cleannotes, trimnotes):
+	#Everything that changes what cleanup_course does, for memo keys
+	return (cleancourse, cleannotes, trimnotes, tuple((name, rules[name]['path'], rules[name]['action'], rules[name]['function']) for name in user_rules))
+
+def process_file(tree, root, tcxfile, num_parts, percent, first, last, cleancourse, cleannotes, trimnotes, prnt, prefix_number, maxpoints=0, file_prefix=None, memo=None, tracks=None, rng=None):
+	"""
+	Process the whole TCX file.  tree is a copy of the skeleton from route_tracks, tracks its Tracks' points and rng the
+	file's random generator (segment_rng).
+	memo is (key, stored) from process_file_segments.  If stored is not None, tree is a copy of this file as an earlier
+	run left it after pruning (stored['stage'] 'prune') or cleanup ('cleanup'), and the stages it has been through are skipped.
+	"""
+	global num_coursepoints, num_trackpoints, num_tracks, num_courses, compact_saved_bytes, prefix, gui, progress_window, mystdout, keep_altitude
+	
+	#GPX output files keep the Trackpoints' altitude (as ele); TCX & FIT files go without, as they always have
+	keep_altitude = output_name(tcxfile, '').endswith('.gpx')
+	memo_key, stored = memo or (None, None)
+	if stored is not None:
+		replay_counter_changes(stored['counters'])
+		print ("Reusing the %s file from the last run" % ('pruned' if stored['stage'] == 'prune' else 'pruned & cleaned up'))
+		counters = stored['counters']
+	else:
+		counters_before = segment_counters()
+		prune_file(root, percent, first, last, maxpoints, tracks, rng)
+		counters = counter_changes(counters_before)
+		if memo_key is not None:
+			memo_put('prune', memo_key, {'stage': 'prune', 'tree': copy.deepcopy(tree), 'counters': counters})
+
+	if (stored is None or stored['stage'] == 'prune') and (cleancourse or cleannotes or trimnotes or user_rules):
+		with stage('cleanup'):
+			for element in root.iter('{%s}Course'%ns1):
 				cleanup_course(element, cleancourse, cleannotes, trimnotes)
+		if memo_key is not None:
+			memo_put('cleanup', memo_key + cleanup_key(cleancourse, cleannotes, trimnotes), {'stage': 'cleanup', 'tree': copy.deepcopy(tree), 'counters': counters})
+
+	if file_prefix is None:
+		file_prefix = prefix
+	with stage('rename'):
+		rename_courses_with_prefix(tree,file_prefix+prefix_number)
+
+	new_name = output_name(tcxfile, file_prefix)
+	file_format = os.path.splitext(new_name)[1][1:]
+	with stage('write'):
+		if compact:
+			compact_removed = compact_tree(root, decimals)
+		output = new_name if out_archive is None else BytesIO()
+		if file_format == 'fit':
+			write_fit(output, root)
+		elif file_format == 'gpx':
+			write_gpx(output, root)
+		else:
+			tree.write(output, encoding='utf-8', xml_declaration=True)
+		if out_archive is not None:
+			add_to_archive(new_name, output.getvalue())
 
-
-
-
-	rename_courses_with_prefix(tree,prefix+prefix_number)
-
-	#new_name = prefix + tcxfile
-	new_name = os.path.join (os.path.dirname(tcxfile), prefix + os.path.basename(tcxfile))
-	tree.write(new_name, encoding='utf-8', xml_declaration=True)
-
-	print ("Result written to " + new_name)
+	if out_archive is not None:
+		print ("Result added to the %s as %s" % ('zip' if isinstance(out_archive, zipfile.ZipFile) else 'tar', os.path.basename(new_name)))
+	else:
+		print ("Result written to " + new_name)
+	if fidelity:
+		print_fidelity()
+	if compact and file_format == 'tcx':
+		saved = compact_removed
+		full_bytes = output_size(new_name) + saved
+		compact_saved_bytes += saved
+		print ("Compact: %s KB smaller (%.0f%%)" % (round(saved / 1024), saved * 100 / full_bytes))
 	if prnt:
-		print ('\n')
-		if num_parts>1:
-			print ("Trimmed to: %s files, %s courses, %s tracks, %s trackpoints (%s per output file), %s coursepoints (%s per output file)"%(num_parts, num_courses, num_tracks, num_trackpoints, round(num_trackpoints/num_parts), num_coursepoints, round(num_coursepoints/num_parts)))
-		else:
-			print ("Trimmed to: %s files, %s courses, %s tracks, %s trackpoints, %s coursepoints"%(num_parts, num_courses, num_tracks, num_trackpoints, num_coursepoints))
+		print_trimmed(num_parts)
 			
 	print('\n')
 	if gui:
@@ -809,6 +2117,103 @@ def process_file(tree, root, tcxfile, num_parts, percent, first, last, cleancour
 		progress_window.FindElement('progresstext').Update(result_string)
 		progress_window.Refresh()
 	#sys.stderr.flush()
+	return new_name
+
+def output_name(tcxfile, file_prefix):
+	#The output file for (segment) file tcxfile: file_prefix in front and, unless --format says otherwise, the input file's format
+	#new_name = prefix + tcxfile
+	new_name = os.path.join (os.path.dirname(tcxfile), file_prefix + os.path.basename(tcxfile))
+	file_format = output_format or ('gpx' if tcxfile.lower().endswith('.gpx') else 'tcx')
+	return os.path.splitext(new_name)[0] + '.' + file_format
+
+def print_fidelity():
+	#--fidelity's line for the output file just written
+	summary = fidelity_summary()
+	if summary['worst']:
+		print ("Fidelity: dropped trackpoints are up to %.1f m (mean %.1f m) from the route; worst stretch km %.1f-%.1f (%s to %s)" % (summary['max'], summary['mean'],
+			summary['worst']['from_km'], summary['worst']['to_km'], summary['worst']['from_time'], summary['worst']['to_time']))
+
+def print_trimmed(num_parts):
+	#The summary after the last output file
+	print ('\n')
+	if num_parts>1:
+		print ("Trimmed to: %s files, %s courses, %s tracks, %s trackpoints (%s per output file), %s coursepoints (%s per output file)"%(num_parts, num_courses, num_tracks, num_trackpoints, round(num_trackpoints/num_parts), num_coursepoints, round(num_coursepoints/num_parts)))
+	else:
+		print ("Trimmed to: %s files, %s courses, %s tracks, %s trackpoints, %s coursepoints"%(num_parts, num_courses, num_tracks, num_trackpoints, num_coursepoints))
+
+'''
+--delta.  Each output file's fingerprint is a hash of everything in the input that goes into it--the file outside its Tracks &
+CoursePoints, its CoursePoints and the Trackpoints in its time window--and of the options.  Distances are hashed counting
+from the start of the window, so a detour earlier in the route (which changes every later running total) doesn't change
+the files after it unless their turns or times changed too.  The fingerprints, counters & stats of the files written are
+kept in <prefix><inputfile>.delta.json; an output file whose fingerprint is unchanged (and which is still there, the size
+it was written) is left as it is.
+'''
+lap_summary_tags = ['{%s}%s'%(ns1, tag) for tag in ('TotalTimeSeconds', 'DistanceMeters', 'BeginPosition', 'EndPosition')]
+
+def delta_file(inputfilename):
+	#Where --delta keeps the fingerprints for this input file
+	return os.path.join(os.path.dirname(inputfilename), prefix + os.path.splitext(os.path.basename(inputfilename))[0] + '.delta.json')
+
+def read_delta(inputfilename):
+	#The output files of the last --delta run on this input file, by name (none if there was no such run)
+	try:
+		with open(delta_file(inputfilename)) as f:
+			return json.load(f)['files']
+	except (OSError, ValueError, KeyError):
+		return {}
+
+def delta_settings(cleancourse, cleannotes, trimnotes):
+	#Everything besides the input that goes into the output files--VPrune itself included
+	with open(__file__, 'rb') as f:
+		program = hashlib.sha1(f.read()).hexdigest()
+	return (program, strategy, seed, min_gap, max_gap, turn_radius, turn_share, distances, cleancourse, cleannotes, trimnotes,
+			[rules[name].get('source', (rules[name]['path'], rules[name]['action'])) for name in user_rules], compact, decimals)
+
+def segment_fingerprints(root, plan, settings):
+	"""
+	The fingerprint of each (first turn, last turn) in plan's output file, with settings (anything hashable by repr).
+	"""
+	skeleton = hashlib.sha1(repr(settings).encode())
+	#Everything but the Tracks, the CoursePoints & the Lap summary the pruning rewrites, in document order
+	stack = [root]
+	while stack:
+		element = stack.pop()
+		if element.tag in ('{%s}Track'%ns1, '{%s}CoursePoint'%ns1):
+			continue
+		if element.tag in lap_summary_tags and element.getparent().tag == '{%s}Lap'%ns1:
+			continue
+		skeleton.update(repr((element.tag, element.text, sorted(element.attrib.items()))).encode())
+		stack.extend(reversed(element))
+
+	courses = []
+	for course in root.iter('{%s}Course'%ns1):
+		tracks = []
+		for track in course.iter('{%s}Track'%ns1):
+			points = track_arrays(track)
+			#Each Trackpoint's content but its running distance total, which is hashed rebased to the window below
+			texts = ['\t'.join('%s=%s' % (element.tag, element.text) for element in trackpoint.iter() if element.tag != '{%s}DistanceMeters'%ns1)
+					 for trackpoint in points['trackpoints']]
+			tracks.append((points, texts))
+		courses.append((course.findall('{%s}CoursePoint/{%s}Time'%(ns1,ns1)), tracks))
+
+	fingerprints = []
+	for first, last in plan:
+		fingerprint = skeleton.copy()
+		for times_elem, tracks in courses:
+			chosen = times_elem[max(first, 1)-1:last]
+			for elem in chosen:
+				fingerprint.update(etree.tostring(elem.getparent(), with_tail=False))
+			if not chosen:
+				continue
+			startT, endT = time_seconds([chosen[0].text, chosen[-1].text])
+			for points, texts in tracks:
+				idx = np.flatnonzero((points['seconds'] >= startT) & (points['seconds'] <= endT))
+				if len(idx):
+					fingerprint.update(np.round(points['dist'][idx] - points['dist'][idx[0]], 2).tobytes())
+					fingerprint.update('\n'.join(texts[i] for i in idx.tolist()).encode())
+		fingerprints.append(fingerprint.hexdigest())
+	return fingerprints
 
 
 def count_file(root, percent, maxpoints, num_parts=1, maxturns=500, split=0, prnt=False, whole=False):
@@ -822,58 +2227,77 @@ def count_file(root, percent, maxpoints, num_parts=1, maxturns=500, split=0, prn
 	orig_total_trackpoints = 0
 	orig_total_coursepoints = 0
 
-
-	for element in root.iter():
-		if element.tag == '{%s}Course'%ns1:
-			orig_total_courses += 1
-			#print (element)
-			#print (element.tag)
-			#print ('\n')
-			times = []
-			#print ('{%s}CoursePoint/{%s}Time'% (ns1,ns1))
-			times_elem = element.findall('{%s}CoursePoint/{%s}Time'% (ns1,ns1))
-
-			for elem in times_elem:
-					#print(elem.text)
-					times.append(elem.text)
-			#print (times)
-
-			orig_total_coursepoints += len(times_elem) #slightly wonky way of counting course points, could be updated to just count <coursepoint> elements
-
-			tracks = []
-
-			for element2 in element.iter():
-				#print (element2.tag)
-				#print ('element2 \n')
-				if element2.tag == '{%s}Track'%ns1:
-					tracks.append(element2)	
-					#print ('appended track \n')
+	#The totals only change with the tree, unless --distances check has something to print
+	counted = None if whole and distances == 'check' else memo_get('count', root)
+	if counted is None:
+		for element in root.iter():
+			if element.tag == '{%s}Course'%ns1:
+				orig_total_courses += 1
+				#print (element)
+				#print (element.tag)
+				#print ('\n')
+				times = []
+				#print ('{%s}CoursePoint/{%s}Time'% (ns1,ns1))
+				times_elem = element.findall('{%s}CoursePoint/{%s}Time'% (ns1,ns1))
+
+				for elem in times_elem:
+						#print(elem.text)
+						times.append(elem.text)
+				#print (times)
+
+				orig_total_coursepoints += len(times_elem) #slightly wonky way of counting course points, could be updated to just count <coursepoint> elements
+
+				tracks = []
+
+				for element2 in element.iter():
+					#print (element2.tag)
+					#print ('element2 \n')
+					if element2.tag == '{%s}Track'%ns1:
+						tracks.append(element2)	
+						#print ('appended track \n')
+						'''
+						expr = "count(//{%s}Track/{%s}Trackpoint)"%(ns1,ns1)
+						expr = "count(//TrainingCenterDatabase/Courses/Course/Track/Trackpoint)"
+						expr = "count(//Trackpoint)"
+						print (expr)
+						#orig_total_trackpoints = root.xpath(expr)
+						#print (orig_total_trackpoints)
+						'''
+				orig_total_tracks += len(tracks)
+				for track in tracks:
+					if whole and distances == 'check':
+						check_distances(track_arrays(track))
 					'''
-					expr = "count(//{%s}Track/{%s}Trackpoint)"%(ns1,ns1)
-					expr = "count(//TrainingCenterDatabase/Courses/Course/Track/Trackpoint)"
-					expr = "count(//Trackpoint)"
-					print (expr)
-					#orig_total_trackpoints = root.xpath(expr)
-					#print (orig_total_trackpoints)
+					#NOT SURE why none of these counting methods work!
+					track_elem = element.findall('{%s}Trackpoint/{%s}Time'%(ns1,ns1))
+					orig_total_trackpoints += len(track_elem)
+					print (orig_total_trackpoints)
+					print (len(track_elem))
+					#print (root.xpath('count(/{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Trackpoint)'))
+					#orig_total_trackpoints += track.xpath('count(//Trackpoint)')
 					'''
-			orig_total_tracks += len(tracks)
-			for track in tracks:
-				'''
-				#NOT SURE why none of these counting methods work!
-				track_elem = element.findall('{%s}Trackpoint/{%s}Time'%(ns1,ns1))
-				orig_total_trackpoints += len(track_elem)
-				print (orig_total_trackpoints)
-				print (len(track_elem))
-				#print (root.xpath('count(/{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Trackpoint)'))
-				#orig_total_trackpoints += track.xpath('count(//Trackpoint)')
-				'''
 				
-				for child in track:
-					#print (child.tag)
-					if child.tag == '{%s}Trackpoint'%ns1:
-						#print ('working')
-						orig_total_trackpoints += 1
+					for child in track:
+						#print (child.tag)
+						if child.tag == '{%s}Trackpoint'%ns1:
+							#print ('working')
+							orig_total_trackpoints += 1
+
+		memo_put('count', root, (orig_total_courses, orig_total_tracks, orig_total_trackpoints, orig_total_coursepoints))
+	else:
+		orig_total_courses, orig_total_tracks, orig_total_trackpoints, orig_total_coursepoints = counted
 
+	ret = count_targets(orig_total_courses, orig_total_tracks, orig_total_trackpoints, orig_total_coursepoints, percent, maxpoints, num_parts, maxturns, split, prnt, whole)
+	if gui:
+		result_string = mystdout.getvalue()			
+		progress_window.FindElement('progresstext').Update(result_string)
+		progress_window.Refresh()
+	return ret
+
+def count_targets(orig_total_courses, orig_total_tracks, orig_total_trackpoints, orig_total_coursepoints, percent, maxpoints, num_parts=1, maxturns=500, split=0, prnt=False, whole=False):
+	"""
+	From the counts of the whole file: the percent of Trackpoints to retain (& maxturns) for num_parts files, printing them if prnt.
+	"""
 	temp_num_parts = num_parts
 	if whole:
 		if maxturns>0:
@@ -914,12 +2338,12 @@ def count_file(root, percent, maxpoints, num_parts=1, maxturns=500, split=0, prn
 		if prnt:
 			print ("Aiming for: %s files, retain %s%% of trackpoints, retain %s total trackpoints in each file"%(temp_num_parts, round(percent), round(maxpoints/temp_num_parts)))
 			print ('\n')
-	if gui:
-		result_string = mystdout.getvalue()			
-		progress_window.FindElement('progresstext').Update(result_string)
-		progress_window.Refresh()
 	return {'percent':percent,'maxturns':maxturns}
 
+def print_targets(counts, percent, maxpoints, num_parts):
+	#Once the split plan is made (the limits may decide the number of files): print the counts & the targets for its num_parts files
+	count_targets(*counts, percent, maxpoints, 1, 0, max(num_parts, 1), True, True)
+
 #Return a tree with course elements x to y and all others, including corresponding track elements, removed
 
 """
@@ -957,13 +2381,292 @@ def tree_prune(tree, root, first, last):
 	print ("Result written to " + new_name)
 	print ("Trimmed to: %s courses, %s tracks, %s trackpoints, %s coursepoints"%(num_courses, num_tracks, num_trackpoints, num_coursepoints))
 """
-def process_file_segments (tree, root, inputfilename, maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes, overlap_num = 4):
-	global gui, progress_window, progress_bar, progress, mystdout
+def route_index(root):
+	"""
+	Prefix arrays for split planning.  For each CoursePoint (turn) of the first Course, in order: the turn number, the
+	number of Trackpoints before the turn's Trackpoint, the cumulative distance (km) and time (hours) there, and a
+	rough count of the bytes of Trackpoints & CoursePoints up to there.
+	"""
+	course = root.find('.//{%s}Course'%ns1)
+	if course is None:
+		course = etree.Element('{%s}Course'%ns1)
+	tracks = [track_arrays(track) for track in course.iter('{%s}Track'%ns1)]
+	seconds = np.concatenate([t['seconds'] for t in tracks] + [np.zeros(0, dtype=np.int64)])
+	dist = np.concatenate([t['dist'] for t in tracks] + [np.zeros(0)])
+	turn_seconds = time_seconds([elem.text for elem in course.findall('{%s}CoursePoint/{%s}Time'%(ns1,ns1))])
+	turns = np.arange(len(turn_seconds), dtype=float)
+	if len(seconds) == 0:
+		return {'turns': turns, 'points': np.zeros(len(turns)), 'km': np.zeros(len(turns)), 'hours': np.zeros(len(turns)), 'bytes': np.zeros(len(turns))}
+	#The turn's own Trackpoint has the same Time; otherwise take the next one along
+	at = np.clip(np.searchsorted(seconds, turn_seconds), 0, len(seconds) - 1)
+	trackpoint_bytes = sample_bytes(course.find('.//{%s}Trackpoint'%ns1))
+	coursepoint_bytes = sample_bytes(course.find('{%s}CoursePoint'%ns1))
+	return {'turns': turns,
+			'points': at.astype(float),
+			'km': dist[at] / 1000,
+			'hours': (turn_seconds - seconds[0]) / 3600,
+			'bytes': np.round(at * trackpoint_bytes + turns * coursepoint_bytes)}
+
+def sample_bytes(elem):
+	#Size of one element as written out, as a guide to the size of the rest like it
+	if elem is None:
+		return 0
+	return len(etree.tostring(elem).replace((' xmlns="%s"'%ns1).encode(), b''))
+
+def turn_split_plan(total_coursepoints, num_parts, overlap_num):
+	"""
+	The original split: num_parts files with the same number of turns each, each file running on overlap_num turns into the next.
+	Returns a list of (start_turn, end_turn) pairs.
+	"""
+	turns_per_part = math.floor(total_coursepoints/num_parts)
+	plan = []
+	for i in range(num_parts):
+		start_turn = i * turns_per_part
+		end_turn = (i+1) * turns_per_part + overlap_num  #add on extra turns to the end of the file, so that files overlap by overlap_num+1 turns (+0 already overlaps by one turn)
+		if (i+1==num_parts or end_turn > total_coursepoints):
+			end_turn = total_coursepoints
+		plan.append((start_turn, end_turn))
+	return plan
+
+def limit_split_plan(index, limits, maxturns, overlap_num):
+	"""
+	Split so that no file goes over any of the limits ({'km': .., 'hours': .., 'points': ..}, measured from the file's first
+	turn to its last, overlap included) or has more than maxturns turns.  Files always start and end at a turn.
+
+	Each file is as long as the limits allow: one binary search per limit on the index's prefix arrays, O(parts x log n).
+	"""
+	total = len(index['points'])
+	plan = []
+	start = 0
+	while True:
+		s = max(start, 1) - 1 #0-based index of the file's first turn
+		bounds = []
+		if maxturns > 0:
+			#The overlap counts towards maxturns (the device's limit); files after the first also hold their first turn, start
+			bounds.append(max(start + maxturns - overlap_num - (1 if start > 0 else 0), start + 1))
+		for key, limit in limits.items():
+			last = int(np.searchsorted(index[key], index[key][s] + limit, 'right')) - 1 #last turn within the limit
+			bounds.append(total if last + 1 >= total else last + 1 - overlap_num)
+		next_start = min([total] + bounds)
+		next_start = max(next_start, start + 1)
+		if next_start >= total:
+			plan.append((start, total))
+			return plan
+		plan.append((start, min(next_start + overlap_num, total)))
+		start = next_start
+
+def balanced_split_plan(index, measure, num_parts, limits, maxturns, overlap_num):
+	"""
+	Split into num_parts files (or as few as the limits allow) choosing the cut turns so that the largest file, measured in
+	index[measure] (turns, points or bytes), is as small as possible.
+
+	Binary search on that largest size: for each guess, limit_split_plan tells whether num_parts files are enough.
+	"""
+	values = index[measure]
+	lo = 0
+	hi = int(math.ceil(values[-1] - values[0]))
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if len(limit_split_plan(index, dict(limits, **{measure: mid}), maxturns, overlap_num)) <= num_parts:
+			hi = mid
+		else:
+			lo = mid + 1
+	return limit_split_plan(index, dict(limits, **{measure: lo}), maxturns, overlap_num)
+
+def split_limits():
+	#The --max-km, --max-hours & --max-trackpoints-per-file limits in force, as keys of route_index
+	limits = {}
+	if max_km > 0:
+		limits['km'] = max_km
+	if max_hours > 0:
+		limits['hours'] = max_hours
+	if max_trackpoints_per_file > 0:
+		limits['points'] = max_trackpoints_per_file - 1
+	return limits
+
+def split_plan(index, total_coursepoints, maxturns, turn_limit, overlap_num, limits):
+	#The split when there are limits or --balance: as long as the limits allow (else by turns), then balanced
+	if limits:
+		plan = limit_split_plan(index, limits, maxturns, overlap_num)
+	else:
+		plan = turn_split_plan(total_coursepoints, math.ceil(total_coursepoints/maxturns), overlap_num)
+	if balance:
+		plan = balanced_split_plan(index, balance, len(plan), limits, turn_limit, overlap_num)
+	return plan
+
+def print_plan(plan, index):
+	for i, (start_turn, end_turn) in enumerate(plan):
+		s = max(start_turn, 1) - 1
+		e = max(end_turn, 1) - 1
+		print ("  File %s: turns %s-%s, %s trackpoints, %.1f km, %.1f hours, about %s KB before pruning"%(i+1, s+1, end_turn, int(index['points'][e] - index['points'][s]) + 1, index['km'][e] - index['km'][s], index['hours'][e] - index['hours'][s], int((index['bytes'][e] - index['bytes'][s]) / 1024)))
+
+def scan_tcx(inputfilename):
+	"""
+	--dry-run: count the Courses, Tracks, Trackpoints & CoursePoints of a .tcx file and find where its turns are, without
+	building the tree--a handful of regular expression scans over a memory map of the file's bytes.  Returns, for each
+	Course, its counts, its name, the route_index prefix arrays and the average sizes of its elements in bytes.
+	CoursePoints without a matching Trackpoint Time are snapped as read_route snaps them (snap_matches).
+	"""
+	def inside(found, begin, end, missing):
+		#The first of found (positions, texts) within each element, from its begin to its end
+		pos, texts = found
+		j = np.searchsorted(pos, begin)
+		ok = j < len(pos)
+		ok[ok] = pos[j[ok]] < end[ok]
+		return np.array(texts + [missing])[np.where(ok, j, len(pos))]
+
+	with open(inputfilename, 'rb') as f:
+		size = os.fstat(f.fileno()).st_size
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+		try:
+			tcx = re.search(rb'<([\w.-]+:)?TrainingCenterDatabase', data[:65536])
+			ns_prefix = re.escape(tcx.group(1) or b'') if tcx else b''
+			def starts(tag):
+				return np.array([m.start() for m in re.finditer(rb'<' + ns_prefix + tag + rb'[\s>]', data)], dtype=np.int64)
+			def ends(tag):
+				return np.array([m.end() for m in re.finditer(rb'</' + ns_prefix + tag + rb'>', data)], dtype=np.int64)
+			def values(tag):
+				found = [(m.start(), m.group(1)) for m in re.finditer(rb'<' + ns_prefix + tag + rb'>([^<]*)', data)]
+				return np.array([pos for pos, text in found], dtype=np.int64), [text for pos, text in found]
+			courses, course_ends = starts(b'Course'), ends(b'Course')
+			tracks = starts(b'Track')
+			trackpoints, trackpoint_ends = starts(b'Trackpoint'), ends(b'Trackpoint')
+			coursepoints, coursepoint_ends = starts(b'CoursePoint'), ends(b'CoursePoint')
+			names = values(b'Name')
+			times = values(b'Time')
+			dists = values(b'DistanceMeters')
+			point_times = inside(times, trackpoints, trackpoint_ends, b'')
+			turn_times = inside(times, coursepoints, coursepoint_ends, b'')
+			unmatched = ~np.isin(turn_times, point_times[point_times != b''])
+			if distances == 'compute' or len(dists[1]) < len(trackpoints) or unmatched.any():
+				lats = values(b'LatitudeDegrees')
+				lons = values(b'LongitudeDegrees')
+		finally:
+			if size:
+				data.close()
+
+	def seconds_of(texts):
+		#Missing times (b'') come out as NaT, which is the smallest int64, as time_seconds gives them
+		return texts.astype('U19').astype('datetime64[s]').astype(np.int64)
+
+	point_seconds = seconds_of(point_times)
+	point_dist = inside(dists, trackpoints, trackpoint_ends, b'nan').astype(float)
+	turn_seconds = seconds_of(turn_times)
+	scan = {'bytes': size, 'courses': [], 'snapped': 0}
+	for number in range(len(courses)):
+		begin, end = courses[number], course_ends[number] if number < len(course_ends) else size
+		a, b = np.searchsorted(trackpoints, [begin, end])
+		c, d = np.searchsorted(coursepoints, [begin, end])
+		seconds, dist, turns = point_seconds[a:b], point_dist[a:b], turn_seconds[c:d]
+		if unmatched.any() and d > c and (point_times[a:b] != b'').any():
+			#As snap_coursepoints: the first Trackpoint with each Time, then the nearest one for the rest
+			first = {}
+			for i, text in enumerate(point_times[a:b].tolist()):
+				if text:
+					first.setdefault(text, i)
+			found = [first.get(text, -1) for text in turn_times[c:d].tolist()]
+			matches = snap_matches(found, seconds.astype(float), point_times[a:b] != b'',
+				inside(lats, trackpoints[a:b], trackpoint_ends[a:b], b'nan').astype(float), inside(lons, trackpoints[a:b], trackpoint_ends[a:b], b'nan').astype(float),
+				inside(lats, coursepoints[c:d], coursepoint_ends[c:d], b'nan').astype(float).tolist(), inside(lons, coursepoints[c:d], coursepoint_ends[c:d], b'nan').astype(float).tolist(),
+				[float(t) if text else math.nan for t, text in zip(turns.tolist(), turn_times[c:d].tolist())])
+			scan['snapped'] += sum(1 for j, i in enumerate(matches) if i >= 0 and found[j] < 0)
+			turns = np.array([seconds[i] if i >= 0 else t for i, t in zip(matches, turns.tolist())], dtype=np.int64)
+		#CoursePoints still without a Time aren't turns (count_file & process_file only see CoursePoint/Time)
+		has_time = turns != np.iinfo(np.int64).min
+		turns = turns[has_time]
+		if len(seconds) and (distances == 'compute' or np.isnan(dist).any()):
+			dist = route_distances(inside(lats, trackpoints[a:b], trackpoint_ends[a:b], b'nan').astype(float),
+				inside(lons, trackpoints[a:b], trackpoint_ends[a:b], b'nan').astype(float))
+		#For the split plan, one element with the whitespace after it as a guide to the size of the rest like it (as route_index)
+		trackpoint_bytes = int(trackpoints[a+1] - trackpoints[a]) if b - a > 1 else int(trackpoint_ends[a] - trackpoints[a]) if b > a else 0
+		coursepoint_bytes = int(coursepoints[c+1] - coursepoints[c]) if d - c > 1 else int(coursepoint_ends[c] - coursepoints[c]) if d > c else 0
+		turn_numbers = np.arange(len(turns), dtype=float)
+		if len(seconds):
+			at = np.clip(np.searchsorted(seconds, turns), 0, len(seconds) - 1)
+			index = {'turns': turn_numbers, 'points': at.astype(float), 'km': dist[at] / 1000, 'hours': (turns - seconds[0]) / 3600,
+				'bytes': np.round(at * trackpoint_bytes + turn_numbers * coursepoint_bytes)}
+		else:
+			index = {'turns': turn_numbers, 'points': np.zeros(len(turns)), 'km': np.zeros(len(turns)), 'hours': np.zeros(len(turns)), 'bytes': np.zeros(len(turns))}
+		#For output sizes, the average sizes
+		trackpoint_bytes = (trackpoint_ends[b-1] - trackpoints[a]) / (b - a) if b > a else 0
+		coursepoint_bytes = (coursepoint_ends[d-1] - coursepoints[c]) / (d - c) if d > c else 0
+		scan['courses'].append({'name': inside(names, courses[number:number+1], np.array([end]), b'')[0].decode('utf-8', 'replace'),
+			'tracks': int(np.searchsorted(tracks, end) - np.searchsorted(tracks, begin)), 'trackpoints': int(b - a), 'coursepoints': len(turns),
+			'index': index, 'trackpoint_bytes': trackpoint_bytes, 'coursepoint_bytes': coursepoint_bytes,
+			'other_bytes': int(end - begin) - (b - a) * trackpoint_bytes - (d - c) * coursepoint_bytes})
+	#Everything outside the Courses (header, Folders) goes in every output file
+	outside = size - sum(int(course_ends[i] - courses[i]) for i in range(min(len(courses), len(course_ends))))
+	for course in scan['courses']:
+		course['other_bytes'] = max(0, course['other_bytes'] + outside)
+	return scan
+
+def dry_run(inputfilename, maxturns, split, maxpoints, percent, overlap_num = 4, tiers = None):
+	"""
+	--dry-run: print what a run with these options would do--the counts, the split plan and, for each output file, its
+	turns and about how many Trackpoints & bytes it would have--from scan_tcx, without parsing the file or writing anything.
+	"""
+	start = time.perf_counter()
+	scan = scan_tcx(inputfilename)
+	print ("Scanned %s (%.1f MB) in %.3f seconds"%(inputfilename, scan['bytes'] / 1048576, time.perf_counter() - start))
+	if scan['snapped']:
+		print ("%s CoursePoints had no matching Trackpoint Time and were snapped to the nearest Trackpoint" % scan['snapped'])
+	print ('\n')
+	if not scan['courses']:
+		print ("No Courses in this file: nothing to do")
+		return
+	if len(scan['courses']) > 1:
+		print ("%s Courses in this file; each is processed separately\n"%len(scan['courses']))
+	if not tiers:
+		tiers = [(maxpoints, percent)]
+	file_format = output_format or ('gpx' if inputfilename.lower().endswith('.gpx') else 'tcx')
+	for number, course in enumerate(scan['courses']):
+		filename = inputfilename
+		if len(scan['courses']) > 1:
+			print ("Course %s: %s"%(number+1, course['name']))
+			filename = course_filename(inputfilename, number+1)
+		#As process_file_segments, from the scanned counts
+		turn_limit = maxturns if maxturns > 0 else 0
+		ret = count_targets(1, course['tracks'], course['trackpoints'], course['coursepoints'], percent, maxpoints, 1, maxturns, split, False, True)
+		course_maxturns = ret['maxturns']
+		total_coursepoints = course['coursepoints']
+		course_overlap = min(max(round(overlap_num), 1), total_coursepoints)
+		index = course['index']
+		limits = split_limits()
+		if (limits or balance) and total_coursepoints > 0:
+			plan = split_plan(index, total_coursepoints, course_maxturns, turn_limit, course_overlap, limits)
+		else:
+			plan = turn_split_plan(total_coursepoints, math.ceil(total_coursepoints/course_maxturns), course_overlap)
+		print_targets((1, course['tracks'], course['trackpoints'], course['coursepoints']), percent, maxpoints, len(plan))
+		print ("Split plan: %s files"%len(plan))
+		if total_coursepoints:
+			print_plan(plan, index)
+		for tier, (tier_maxpoints, tier_percent) in enumerate(tiers):
+			tier_prefix = prefix
+			if len(tiers) > 1:
+				tier_prefix = prefix + ("%i_"%tier_maxpoints if tier_maxpoints else "%ipct_"%tier_percent)
+			segmentpercent = count_targets(1, course['tracks'], course['trackpoints'], course['coursepoints'], tier_percent, tier_maxpoints, len(plan), course_maxturns, False)['percent']
+			for i, (start_turn, end_turn) in enumerate(plan):
+				s = max(start_turn, 1) - 1
+				e = max(end_turn, 1) - 1
+				points = int(index['points'][e] - index['points'][s]) + 1 if total_coursepoints else course['trackpoints']
+				turns = end_turn - s
+				kept = segment_budget(points, turns, segmentpercent, tier_maxpoints)
+				name = os.path.join(os.path.dirname(filename), tier_prefix + "%i_"%(i+1) + os.path.splitext(os.path.basename(filename))[0] + '.' + file_format)
+				print ("  %s: turns %s-%s, about %s of %s trackpoints kept, about %s KB as .tcx"%(name, s+1, end_turn, kept, points,
+					int((course['other_bytes'] + kept * course['trackpoint_bytes'] + turns * course['coursepoint_bytes']) / 1024)))
+		print ('\n')
+
+def process_file_segments (tree, root, inputfilename, maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes, overlap_num = 4, tiers = None):
+	"""
+	Split the file into segments and write each one.  tiers is a list of (maxpoints, percent) to write a set of files for
+	each (--maxpoints 250,500,1500); they all share one parse & one split plan, and each set of files gets its own prefix.
+	"""
+	global gui, progress_window, progress_bar, progress, mystdout, num_courses, num_tracks, num_trackpoints, num_coursepoints, fidelity_stats, compact_saved_bytes
 	#num_parts = math.ceil(orig_total_coursepoints/maxturns)
-	ret = count_file(root, percent, maxpoints, 1, maxturns, split, True, True)
+	turn_limit = maxturns if maxturns > 0 else 0 #--maxturns is a hard limit; --split only sets the number of files
+	with stage('count'):
+		ret = count_file(root, percent, maxpoints, 1, maxturns, split, False, True)
 	maxturns = ret['maxturns']
-	num_parts = math.ceil(orig_total_coursepoints/maxturns)
-	turns_per_part = math.floor(orig_total_coursepoints/num_parts)
 	total_coursepoints = orig_total_coursepoints
 	
 	overlap_num = round(overlap_num)
@@ -972,37 +2675,541 @@ def process_file_segments (tree, root, inputfilename, maxturns, split, maxpoints
 	if overlap_num > total_coursepoints:
 		overlap_num = total_coursepoints
 
-	for i in range(num_parts):
-		start_turn = i * turns_per_part
-		end_turn = (i+1) * turns_per_part + overlap_num  #add on three extra turns to the end of the file, so that files overlap by about 4 turns (+0 already overlaps by one turn)  TODO: This could be settable via a field
-		prnt=False
-		if (i+1==num_parts or end_turn > total_coursepoints):
-			end_turn = total_coursepoints
-			prnt=True
-		newtree = copy.deepcopy(tree)
-		newroot = newtree.getroot()
-		ret = count_file(newroot, percent, maxpoints, num_parts, maxturns, False)	
+	limits = split_limits()
+	if (limits or balance) and total_coursepoints > 0:
+		with stage('segment'):
+			index = memo_get('index', root)
+			if index is None:
+				index = route_index(root)
+				memo_put('index', root, index)
+		plan = split_plan(index, total_coursepoints, maxturns, turn_limit, overlap_num, limits)
+		print_targets((orig_total_courses, orig_total_tracks, orig_total_trackpoints, orig_total_coursepoints), percent, maxpoints, len(plan))
+		print ("Split plan: %s files"%len(plan))
+		print_plan(plan, index)
+		print ('\n')
+	else:
+		plan = turn_split_plan(total_coursepoints, math.ceil(orig_total_coursepoints/maxturns), overlap_num)
+		print_targets((orig_total_courses, orig_total_tracks, orig_total_trackpoints, orig_total_coursepoints), percent, maxpoints, len(plan))
+	num_parts = len(plan)
+
+	if not tiers:
+		tiers = [(maxpoints, percent)]
+
+	#Read the Tracks' points once; each segment is a copy of the file without them, and gets its own time window of them
+	with stage('segment'):
+		tracks = memo_get('tracks', (root, distances))
+		if tracks is None:
+			tracks = route_tracks(tree)
+			memo_put('tracks', (root, distances), tracks)
+		tracks, skeleton = tracks
+
+	segment_files = []
+	if delta:
+		last_files = read_delta(inputfilename)
+		delta_files = {}
+		settings = delta_settings(cleancourse, cleannotes, trimnotes)
+	for tier, (tier_maxpoints, tier_percent) in enumerate(tiers):
+		tier_prefix = prefix
+		if len(tiers) > 1:
+			tier_prefix = prefix + ("%i_"%tier_maxpoints if tier_maxpoints else "%ipct_"%tier_percent)
+			print ("Files starting %s: %s"%(tier_prefix, "%s trackpoints each"%tier_maxpoints if tier_maxpoints else "%s%% of trackpoints"%tier_percent))
+			#Count each set of files on its own, for its 'Trimmed to' summary
+			tier_totals = (num_courses, num_tracks, num_trackpoints, num_coursepoints)
+			num_courses = num_tracks = num_trackpoints = num_coursepoints = 0
+		#Every segment is a copy of the whole file, so one count gives the percent for all of them
+		with stage('count'):
+			ret = count_file(root, tier_percent, tier_maxpoints, num_parts, maxturns, False)
 		segmentpercent = ret ['percent']
-		prefix_number = "%i_"%(i+1)
-		segment_filename = os.path.join(os.path.dirname(inputfilename), "%i_%s"%(i+1,os.path.basename(inputfilename)))
-		process_file(newtree, newroot, segment_filename, num_parts, segmentpercent, start_turn, end_turn, cleancourse, cleannotes, trimnotes, prnt, prefix_number)
-		if gui:
-			result_string = mystdout.getvalue()			
-			progress_window.FindElement('progresstext').Update(result_string)
-			progress_window.Refresh()
-			progress= 100/num_parts*(i+1)			
-			if weborgui != 'web':
-				progress_bar.UpdateBar(progress)
+		if delta:
+			with stage('segment'):
+				fingerprints = segment_fingerprints(root, plan, settings + (tier_maxpoints, None if tier_maxpoints else segmentpercent, tier_prefix))
+		for i, (start_turn, end_turn) in enumerate(plan):
+			prnt = (i+1==num_parts)
+			segment_start = time.perf_counter()
+			times_before = dict(stage_times)
+			points_before = num_window_trackpoints
+			kept_before = num_trackpoints
+			coursepoints_before = num_coursepoints
+			saved_before = compact_saved_bytes
+			fidelity_stats = {'max': 0.0, 'sum': 0.0, 'count': 0, 'worst': None}
+			segment_filename = os.path.join(os.path.dirname(inputfilename), "%i_%s"%(i+1,os.path.basename(inputfilename)))
+			if delta:
+				new_name = output_name(segment_filename, tier_prefix)
+				last_run = last_files.get(new_name)
+				if last_run and last_run['fingerprint'] == fingerprints[i] and os.path.isfile(new_name) and os.path.getsize(new_name) == last_run['stats']['bytes']:
+					#This part of the route is as it was: leave the file alone, and count it as the last run did
+					replay_counter_changes(last_run['counters'])
+					compact_saved_bytes += last_run['stats']['bytes_saved']
+					print ("%s: this part of the route has not changed since the last run; left as it is" % new_name)
+					if fidelity:
+						print_fidelity()
+					if prnt:
+						print_trimmed(num_parts)
+					print ('\n')
+					segment_files.append(new_name)
+					segment_stats.append(dict(last_run['stats'], seconds=time.perf_counter() - segment_start, stages={}))
+					delta_files[new_name] = last_run
+					continue
+				counters_before = segment_counters()
+			memo_key = stored = None
+			if memoize:
+				#Everything the pruned file depends on; the file name & prefix only come in at the rename & write stages
+				memo_key = (tree, i, start_turn, end_turn, segmentpercent, tier_maxpoints, strategy, seed, min_gap, max_gap, turn_radius, turn_share,
+							distances, measure_error, fidelity, output_format)
+				stored = memo_get('cleanup', memo_key + cleanup_key(cleancourse, cleannotes, trimnotes)) or memo_get('prune', memo_key)
+			with stage('segment'):
+				newtree = copy.deepcopy(stored['tree'] if stored else skeleton)
+			newroot = newtree.getroot()
+			prefix_number = "%i_"%(i+1)
+			segment_files.append(process_file(newtree, newroot, segment_filename, num_parts, segmentpercent, start_turn, end_turn, cleancourse, cleannotes, trimnotes, prnt, prefix_number, tier_maxpoints, tier_prefix,
+				(memo_key, stored), tracks, segment_rng(i+1)))
+			segment_seconds = time.perf_counter() - segment_start
+			lap = newroot.find('.//{%s}Lap'%ns1)
+			segment_stats.append({'file': segment_files[-1], 'tier': tier+1, 'turns': [max(start_turn, 1), end_turn], 'trackpoints': num_window_trackpoints - points_before,
+				'kept': num_trackpoints - kept_before, 'removed': num_window_trackpoints - points_before - (num_trackpoints - kept_before),
+				'coursepoints': num_coursepoints - coursepoints_before,
+				'meters': float(lap.findtext('{%s}DistanceMeters'%ns1) or 0) if lap is not None else 0.0,
+				'duration': float(lap.findtext('{%s}TotalTimeSeconds'%ns1) or 0) if lap is not None else 0.0,
+				'bytes': output_size(segment_files[-1]), 'bytes_saved': compact_saved_bytes - saved_before, 'seconds': segment_seconds,
+				'stages': {name: stage_times.get(name, 0.0) - times_before.get(name, 0.0) for name in stage_times}})
+			if fidelity:
+				segment_stats[-1]['fidelity'] = fidelity_summary()
+			if delta:
+				delta_files[new_name] = {'fingerprint': fingerprints[i], 'counters': counter_changes(counters_before),
+					'stats': {name: value for name, value in segment_stats[-1].items() if name not in ('seconds', 'stages')}}
+			if gui:
+				result_string = mystdout.getvalue()			
+				progress_window.FindElement('progresstext').Update(result_string)
+				progress_window.Refresh()
+				progress= 100/(num_parts*len(tiers))*(tier*num_parts+i+1)
+				if weborgui != 'web':
+					progress_bar.UpdateBar(progress)
+		if len(tiers) > 1:
+			num_courses += tier_totals[0]
+			num_tracks += tier_totals[1]
+			num_trackpoints += tier_totals[2]
+			num_coursepoints += tier_totals[3]
 		#sys.stderr.flush()
+	if delta:
+		written = sum(1 for name in delta_files if delta_files[name] is not last_files.get(name))
+		print ("Delta: %s of %s files written, the rest are unchanged since the last run" % (written, len(delta_files)))
+		for name in sorted(set(last_files) - set(delta_files)):
+			if os.path.isfile(name):
+				print ("%s is from the last run and no longer part of the route" % name)
+		with open(delta_file(inputfilename), 'w') as f:
+			json.dump({'input': os.path.basename(inputfilename), 'files': delta_files}, f, indent=1)
+	return segment_files
 
 
 				
 
+def split_courses(tree):
+	"""
+	One tree per Course, each with everything else in the file (Folders etc.) but only its own Course & CourseNameRef.
+	"""
+	root = tree.getroot()
+	courses = root.findall('{%s}Courses/{%s}Course'%(ns1,ns1))
+	if len(courses) < 2:
+		return [tree]
+	skeleton = copy.deepcopy(root)
+	for course in skeleton.findall('{%s}Courses/{%s}Course'%(ns1,ns1)):
+		remove_element(course)
+	course_trees = []
+	for course in courses:
+		newroot = copy.deepcopy(skeleton)
+		name = course.findtext('{%s}Name'%ns1)
+		for ref in newroot.findall('.//{%s}CourseNameRef'%ns1):
+			if ref.findtext('{%s}Id'%ns1) != name:
+				remove_element(ref)
+		courses_elem = newroot.find('{%s}Courses'%ns1)
+		course = copy.deepcopy(course)
+		if len(courses_elem):
+			courses_elem[-1].tail = course.tail
+		else:
+			courses_elem.text = courses[0].getparent().text
+		course.tail = courses[-1].tail
+		courses_elem.append(course)
+		course_trees.append(etree.ElementTree(newroot))
+	return course_trees
+
+def remove_element(elem):
+	#Remove elem, leaving the whitespace around it tidy
+	previous = elem.getprevious()
+	if previous is not None:
+		previous.tail = elem.tail
+	else:
+		elem.getparent().text = elem.tail
+	elem.getparent().remove(elem)
+
+def course_filename(inputfilename, number):
+	#Files for the 2nd Course of route.tcx are named like vp_1_c2_route.tcx
+	return os.path.join(os.path.dirname(inputfilename), "c%i_%s"%(number, os.path.basename(inputfilename)))
+
+def process_course(course_xml, filename, segment_args):
+	"""
+	Process pool worker: prune, split & write one Course, which arrives as serialized XML.
+	Returns the Course's counters and everything it printed.
+	"""
+	global gui, stage_times, memoize
+	#Without a pool (in the GUI, say) this runs in the main process, whose settings must survive it
+	saved_gui, saved_memoize = gui, memoize
+	gui = False
+	memoize = False #the Course is parsed afresh every run, so nothing stored for it could be found again
+	initVals()
+	stage_times = {}
+	try:
+		with stage('parse'):
+			tree = etree.ElementTree(etree.fromstring(course_xml))
+		output = StringIO()
+		with redirect_stdout(output):
+			segment_files = process_file_segments (tree, tree.getroot(), filename, *segment_args)
+	finally:
+		gui, memoize = saved_gui, saved_memoize
+	return {'output': output.getvalue(), 'courses': num_courses, 'tracks': num_tracks, 'trackpoints': num_trackpoints,
+			'coursepoints': num_coursepoints, 'files': len(segment_files), 'route_error': route_error, 'stage_times': stage_times,
+			'segment_stats': segment_stats}
+
+def process_courses(tree, inputfilename, maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes, overlap_num = 4, tiers = None):
+	"""
+	Process every Course in the file.  A file with several Courses (a week of stages, say) has each Course pruned, split and
+	written separately--in parallel on a process pool where the platform can fork--and then a combined summary printed.
+	"""
+	global num_courses, num_tracks, num_trackpoints, num_coursepoints, route_error, stage_times, segment_stats
+	segment_args = (maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes, overlap_num, tiers)
+	course_trees = split_courses(tree)
+	if len(course_trees) == 1:
+		process_file_segments (tree, tree.getroot(), inputfilename, *segment_args)
+		return
+
+	print ("%s Courses in this file; each is processed separately\n"%len(course_trees))
+	with stage('segment'):
+		work = [(etree.tostring(course_tree), course_filename(inputfilename, i+1), segment_args) for i, course_tree in enumerate(course_trees)]
+	total_times = dict(stage_times)
+	total_segments = list(segment_stats)
+	processes = jobs if jobs > 0 else (os.cpu_count() or 1)
+	if profile_file or memtrace or out_archive is not None or gui:
+		#cProfile & tracemalloc only see this process, only this process can add to the tar or zip, and forking the GUI
+		#(Tk, the download server's thread) is not safe
+		processes = 1
+	if 'fork' in multiprocessing.get_all_start_methods() and processes > 1:
+		#Workers inherit all the settings from this process, so only the Course itself needs sending
+		pool = ProcessPoolExecutor(max_workers=min(processes, len(work)), mp_context=multiprocessing.get_context('fork'))
+		results = pool.map(process_course, *zip(*work))
+	else:
+		pool = None
+		results = (process_course(*w) for w in work)
+
+	totals = {'files': 0, 'courses': 0, 'tracks': 0, 'trackpoints': 0, 'coursepoints': 0}
+	total_error = {'max': 0.0, 'sum': 0.0, 'count': 0}
+	for i, result in enumerate(results):
+		print ("Course %s:"%(i+1))
+		print (result['output'])
+		for key in totals:
+			totals[key] += result[key]
+		total_error['max'] = max(total_error['max'], result['route_error']['max'])
+		total_error['sum'] += result['route_error']['sum']
+		total_error['count'] += result['route_error']['count']
+		for name, seconds in result['stage_times'].items():
+			total_times[name] = total_times.get(name, 0.0) + seconds
+		for stats in result['segment_stats']:
+			total_segments.append(dict(stats, course=i+1))
+		if gui:
+			progress_window.FindElement('progresstext').Update(mystdout.getvalue())
+			progress_window.Refresh()
+			if weborgui != 'web':
+				progress_bar.UpdateBar(100/len(work)*(i+1))
+	if pool is not None:
+		pool.shutdown()
+
+	num_courses = totals['courses']
+	num_tracks = totals['tracks']
+	num_trackpoints = totals['trackpoints']
+	num_coursepoints = totals['coursepoints']
+	route_error = total_error
+	stage_times = total_times
+	segment_stats = total_segments
+	print ("All Courses: %s files, %s courses, %s tracks, %s trackpoints, %s coursepoints"%(totals['files'], num_courses, num_tracks, num_trackpoints, num_coursepoints))
+
+def bench_strategies(inputfilename, maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes, overlap_num = 4):
+	"""
+	Run every registered pruning strategy over the same file & options and print runtime, Trackpoints kept,
+	output size and geometric error side by side.  Output files go to a temporary directory and are deleted.
+	"""
+	global strategy, measure_error
+	tree = read_route(inputfilename)
+	root = tree.getroot()
+	chosen_strategy = strategy
+	results = []
+	for name in prune_strategies:
+		initVals()
+		strategy = name
+		measure_error = True
+		workdir = tempfile.mkdtemp(prefix='vprune_bench_')
+		try:
+			with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+				start = time.perf_counter()
+				process_courses (tree, os.path.join(workdir, os.path.basename(inputfilename)), maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes, overlap_num)
+				seconds = time.perf_counter() - start
+			output_bytes = sum(os.path.getsize(os.path.join(workdir, f)) for f in os.listdir(workdir))
+		finally:
+			shutil.rmtree(workdir, ignore_errors=True)
+		mean_error = route_error['sum'] / route_error['count'] if route_error['count'] else 0
+		results.append((name, seconds, num_trackpoints, output_bytes, route_error['max'], mean_error))
+	strategy = chosen_strategy
+	measure_error = False
+
+	print ()
+	print ("%-12s %10s %12s %12s %14s %14s" % ('strategy', 'seconds', 'trackpoints', 'bytes', 'max error (m)', 'mean error (m)'))
+	for result in results:
+		print ("%-12s %10.3f %12d %12d %14.1f %14.2f" % result)
+	print ()
+	return results
+
+street_names = ['Main', 'Oak', 'River', 'Mill', 'Church', 'Station', 'Highland', 'Lake', 'Maple', 'Ridge', 'Cedar', 'Spring', 'Valley', 'Park', 'Hill', 'Meadow', 'Forest', 'Prairie', 'Bluff', 'Orchard']
+street_kinds = ['St', 'Rd', 'Ave', 'Blvd', 'Ln', 'Dr', 'Trail', 'Hwy']
+
+def generate_tcx(outputfilename, num_trackpoints, turn_every=20, generator_seed=0, chunk=10000):
+	"""
+	Write a made-up route shaped like a RideWithGPS export: a Trackpoint every 10 seconds with position, altitude & distance,
+	a turn CoursePoint (with Notes) on average every turn_every Trackpoints--busier in towns, quieter in the country--and
+	about one Generic CoursePoint in ten.  The same arguments always give the same file, and it is written a chunk at a
+	time so even a 5 million point route only needs a few arrays in memory.
+	"""
+	generator = np.random.default_rng(generator_seed)
+	n = max(int(num_trackpoints), 2)
+
+	#Turns: gaps drawn around turn_every, with stretches of 2000 Trackpoints alternating between busy, normal & quiet
+	gap_scale = np.array([0.25, 1.0, 4.0])
+	turns = []
+	i = 1
+	while i < n - 1:
+		turns.append(i)
+		i += max(2, int(generator.exponential(turn_every * gap_scale[(i // 2000) % 3])))
+	turns = np.array(turns, dtype=np.int64)
+	turn_angle = generator.uniform(0.5, 2.0, len(turns)) * generator.choice([-1, 1], len(turns))
+	straight = generator.random(len(turns)) < 0.08
+	turn_angle[straight] = generator.normal(0, 0.1, int(straight.sum()))
+
+	heading = generator.normal(0, 0.05, n)
+	heading[0] = generator.uniform(0, 2 * math.pi)
+	heading[turns] += turn_angle
+	heading = np.cumsum(heading)
+	step = np.clip(generator.normal(6.0, 2.0, n), 0.5, 15.0) * 10
+	step[0] = 0.0
+	lat = 39.13473 + np.cumsum(step * np.cos(heading)) / 111195.0
+	lon = -94.42453 + np.cumsum(step * np.sin(heading)) / (111195.0 * np.cos(np.radians(lat)))
+	altitude = 280 + np.cumsum(generator.normal(0, 0.8, n))
+	dist = np.cumsum(step)
+	seconds = np.arange(n, dtype=np.int64) * 10
+	start = np.datetime64('2019-08-03T08:00:00')
+	times = np.datetime_as_string(start + seconds.astype('timedelta64[s]')).astype(object) + 'Z'
+
+	#CoursePoints: the start, every turn, extra Generic points (water, food & the like) and the end
+	generic = np.flatnonzero(generator.random(n) < len(turns) / 9.0 / n)
+	points = [(0, 'Generic', 'Start of route')]
+	for i in sorted(set(turns.tolist()) | set(generic.tolist())):
+		name = "%s %s" % (street_names[generator.integers(len(street_names))], street_kinds[generator.integers(len(street_kinds))])
+		position = np.searchsorted(turns, i)
+		if position < len(turns) and turns[position] == i:
+			angle = turn_angle[position]
+			if straight[position]:
+				points.append((i, 'Straight', 'Continue onto %s' % name))
+			elif angle < 0:
+				points.append((i, 'Left', '%sleft onto %s' % ('Slight ' if angle > -0.8 else 'Turn ', name)))
+			else:
+				points.append((i, 'Right', '%sright onto %s' % ('Slight ' if angle < 0.8 else 'Turn ', name)))
+		else:
+			points.append((i, 'Generic', ['Water at %s', 'Food stop: %s Cafe', 'Restrooms at %s Park', 'Caution: rough road on %s'][generator.integers(4)] % name))
+	points.append((n - 1, 'Generic', 'End of route'))
+
+	course_name = "Synthetic-%i" % n
+	with open(outputfilename, 'w', encoding='utf-8', newline='\n') as out:
+		out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+		out.write('<TrainingCenterDatabase xmlns="%s" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="%s http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd">\n' % (ns1, ns1))
+		out.write('  <Folders>\n    <Courses>\n      <CourseFolder Name="Courses">\n        <CourseNameRef>\n          <Id>%s</Id>\n        </CourseNameRef>\n      </CourseFolder>\n    </Courses>\n  </Folders>\n' % course_name)
+		out.write('  <Courses>\n    <Course>\n      <Name>%s</Name>\n      <Lap>\n' % course_name)
+		out.write('        <TotalTimeSeconds>%i</TotalTimeSeconds>\n        <DistanceMeters>%.1f</DistanceMeters>\n' % (seconds[-1], dist[-1]))
+		out.write('        <BeginPosition>\n          <LatitudeDegrees>%.6f</LatitudeDegrees>\n          <LongitudeDegrees>%.6f</LongitudeDegrees>\n        </BeginPosition>\n' % (lat[0], lon[0]))
+		out.write('        <EndPosition>\n          <LatitudeDegrees>%.6f</LatitudeDegrees>\n          <LongitudeDegrees>%.6f</LongitudeDegrees>\n        </EndPosition>\n' % (lat[-1], lon[-1]))
+		out.write('        <Intensity>Active</Intensity>\n      </Lap>\n      <Track>\n')
+		trackpoint = ('        <Trackpoint>\n          <Time>%s</Time>\n          <Position>\n            <LatitudeDegrees>%.6f</LatitudeDegrees>\n'
+			'            <LongitudeDegrees>%.6f</LongitudeDegrees>\n          </Position>\n          <AltitudeMeters>%.1f</AltitudeMeters>\n'
+			'          <DistanceMeters>%.3f</DistanceMeters>\n        </Trackpoint>\n')
+		for first in range(0, n, chunk):
+			last = min(first + chunk, n)
+			out.write(''.join([trackpoint % row for row in zip(times[first:last], lat[first:last].tolist(), lon[first:last].tolist(), altitude[first:last].tolist(), dist[first:last].tolist())]))
+		out.write('      </Track>\n')
+		coursepoint = ('      <CoursePoint>\n        <Name>%s</Name>\n        <Time>%s</Time>\n        <Position>\n          <LatitudeDegrees>%.6f</LatitudeDegrees>\n'
+			'          <LongitudeDegrees>%.6f</LongitudeDegrees>\n        </Position>\n        <PointType>%s</PointType>\n        <Notes>%s</Notes>\n      </CoursePoint>\n')
+		for first in range(0, len(points), chunk):
+			out.write(''.join([coursepoint % (html.escape(notes.split(' onto ')[-1][:10]), times[i], lat[i], lon[i], point_type, html.escape(notes)) for i, point_type, notes in points[first:first + chunk]]))
+		out.write('    </Course>\n  </Courses>\n</TrainingCenterDatabase>\n')
+	return {'trackpoints': n, 'coursepoints': len(points)}
+
+def run_benchmark(sizes, baselinefile, threshold, maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes, overlap_num = 4):
+	"""
+	Generate a made-up route of each size, run it through vprune with the current options and time each stage.
+	With a baseline file, flag every stage that is more than threshold percent slower than the baseline (or save
+	this run as the baseline if the file does not exist).  Returns the number of regressions.
+	"""
+	global timing, stage_times
+	results = {}
+	for size in sizes:
+		workdir = tempfile.mkdtemp(prefix='vprune_benchmark_')
+		try:
+			inputfilename = os.path.join(workdir, 'route%i.tcx' % size)
+			route = generate_tcx(inputfilename, size, generator_seed=seed)
+			input_bytes = os.path.getsize(inputfilename)
+			initVals()
+			timing = True
+			stage_times = {}
+			with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+				start = time.perf_counter()
+				with stage('parse'):
+					tree = etree.parse(inputfilename)
+				process_courses (tree, inputfilename, maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes, overlap_num)
+				seconds = time.perf_counter() - start
+			del tree
+		finally:
+			timing = False
+			shutil.rmtree(workdir, ignore_errors=True)
+		results[str(size)] = {'trackpoints': route['trackpoints'], 'coursepoints': route['coursepoints'], 'bytes': input_bytes,
+			'total': seconds, 'stages': {name: stage_times.get(name, 0.0) for name in stage_names}}
+
+	print ()
+	print ("%12s " % 'trackpoints' + " ".join("%9s" % name for name in stage_names) + " %9s %12s" % ('total', 'points/sec'))
+	for size, result in results.items():
+		print ("%12s " % size + " ".join("%9.3f" % result['stages'][name] for name in stage_names) + " %9.3f %12d" % (result['total'], result['trackpoints'] / result['total']))
+	print ()
+
+	run = {'python': platform.python_version(), 'machine': platform.machine(), 'strategy': strategy, 'maxpoints': maxpoints, 'results': results}
+	if not baselinefile:
+		return 0
+	if not os.path.isfile(baselinefile):
+		with open(baselinefile, 'w') as f:
+			json.dump(run, f, indent=1)
+		print ("Baseline saved to %s" % baselinefile)
+		return 0
+
+	with open(baselinefile) as f:
+		baseline = json.load(f)
+	regressions = 0
+	for size, result in results.items():
+		if size not in baseline['results']:
+			print ("%s trackpoints: not in the baseline" % size)
+			continue
+		before = baseline['results'][size]
+		for name in stage_names + ['total']:
+			old = before['total'] if name == 'total' else before['stages'].get(name, 0.0)
+			new = result['total'] if name == 'total' else result['stages'][name]
+			#Ignore a few milliseconds either way--short stages are mostly timer noise
+			if new > old * (1 + threshold / 100) and new - old > 0.005:
+				regressions += 1
+				print ("REGRESSION %s trackpoints, %s: %.3fs, baseline %.3fs (+%.0f%%)" % (size, name, new, old, (new / old - 1) * 100 if old else float('inf')))
+	if regressions:
+		print ("%s regressions more than %g%% slower than %s" % (regressions, threshold, baselinefile))
+	else:
+		print ("No stage more than %g%% slower than %s" % (threshold, baselinefile))
+	return regressions
+
+def input_counts(inputfilename, root):
+	#Size & contents of the input file, for --report
+	return {'file': inputfilename, 'bytes': os.path.getsize(inputfilename) if inputfilename != '-' else None,
+		'courses': len(root.findall('{%s}Courses/{%s}Course'%(ns1,ns1))),
+		'tracks': len(root.findall('{%s}Courses/{%s}Course/{%s}Track'%(ns1,ns1,ns1))),
+		'trackpoints': len(root.findall('{%s}Courses/{%s}Course/{%s}Track/{%s}Trackpoint'%(ns1,ns1,ns1,ns1))),
+		'coursepoints': len(root.findall('{%s}Courses/{%s}Course/{%s}CoursePoint'%(ns1,ns1,ns1)))}
+
+def write_report(reportfile, input_info, parameters, seconds):
+	"""
+	Save the --report JSON: what went in, the options used, what came out (in total & file by file) and how long it took.
+	"""
+	report = {'input': input_info, 'parameters': parameters,
+		'output': {'files': len(segment_stats), 'courses': num_courses, 'tracks': num_tracks, 'trackpoints': num_trackpoints,
+			'coursepoints': num_coursepoints, 'bytes': sum(stats['bytes'] for stats in segment_stats),
+			'bytes_saved': sum(stats['bytes_saved'] for stats in segment_stats)},
+		'seconds': seconds,
+		'segments': [{key: value for key, value in stats.items() if key != 'stages' or timing} for stats in segment_stats]}
+	if memtrace:
+		report['memory'] = {'peak_rss': peak_rss_bytes(), 'stages': stage_memory}
+	if isinstance(out_archive, zipfile.ZipFile):
+		#Web GUI: the report goes in the zip with the output files
+		out_archive.writestr(reportfile, json.dumps(report, indent=1))
+		print ("Report added to the zip as %s" % reportfile)
+		return
+	with open(reportfile, 'w') as f:
+		json.dump(report, f, indent=1)
+	print ("Report written to %s" % reportfile)
+
+def run_parameters(maxturns, split, overlap_num, maxpoints, percent, tiers, cleancourse, cleannotes, trimnotes):
+	#The options used, for the report
+	return {'maxturns': maxturns, 'split': split, 'overlap_num': overlap_num, 'max_km': max_km, 'max_hours': max_hours,
+		'max_trackpoints_per_file': max_trackpoints_per_file, 'balance': balance, 'maxpoints': maxpoints, 'percent': percent, 'tiers': tiers,
+		'strategy': strategy, 'seed': seed, 'min_gap': min_gap, 'max_gap': max_gap, 'turn_radius': turn_radius, 'turn_share': turn_share,
+		'distances': distances, 'fidelity': fidelity, 'format': output_format, 'compact': compact, 'decimals': decimals, 'cleancourse': cleancourse, 'cleannotes': cleannotes, 'trimnotes': trimnotes, 'prefix': prefix, 'jobs': jobs}
+
+def print_memtrace(start_snapshot, top=10):
+	"""
+	The --memtrace report: memory used by each stage, and the lines of code holding the most memory since the run started.
+	Python's own allocations (tracemalloc) don't include the XML trees, which lxml keeps outside Python--watch RSS for those.
+	"""
+	mb = 1024 * 1024
+	print ()
+	print ("MEMORY: peak resident memory (RSS) %.1f MB, now %.1f MB, %s bit Python" % (peak_rss_bytes() / mb, rss_bytes() / mb, 64 if sys.maxsize > 2**32 else 32))
+	print ()
+	print ("%-10s %6s %15s %19s %13s %16s" % ('stage', 'calls', 'Python peak MB', 'Python retained MB', 'max RSS MB', 'RSS growth MB'))
+	for name in stage_names:
+		if name in stage_memory:
+			memory = stage_memory[name]
+			print ("%-10s %6s %15.1f %19.1f %13.1f %16.1f" % (name, memory['calls'], memory['peak'] / mb, memory['retained'] / mb, memory['rss'] / mb, memory['rss_growth'] / mb))
+	print ()
+	print ("Most Python memory still held, by line of code:")
+	#Leave out modules being imported (numpy loading its extras, say) and tracemalloc itself
+	ignore = [tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'), tracemalloc.Filter(False, tracemalloc.__file__)]
+	for difference in tracemalloc.take_snapshot().filter_traces(ignore).compare_to(start_snapshot.filter_traces(ignore), 'lineno')[:top]:
+		frame = difference.traceback[0]
+		print ("  %10.1f KB %9s blocks  %s:%s" % (difference.size_diff / 1024, difference.count_diff, frame.filename, frame.lineno))
+	print ()
+
+def print_profile(seconds):
+	"""
+	The --profile report: time taken by each stage and by each output file, with trackpoints/second.
+	"""
+	trackpoints = sum(stats['trackpoints'] for stats in segment_stats)
+	print ()
+	print ("PROFILE: %.3f seconds in all, %s trackpoints through the output files, %d trackpoints/second" % (seconds, trackpoints, trackpoints / seconds if seconds else 0))
+	print ()
+	print ("%-10s %9s %7s" % ('stage', 'seconds', 'share'))
+	for name in stage_names:
+		print ("%-10s %9.3f %6.1f%%" % (name, stage_times.get(name, 0.0), stage_times.get(name, 0.0) * 100 / seconds if seconds else 0))
+	other = seconds - sum(stage_times.values())
+	print ("%-10s %9.3f %6.1f%%" % ('other', other, other * 100 / seconds if seconds else 0))
+	print ()
+	print ("%-30s %11s %11s %9s %9s %12s " % ('file', 'turns', 'trackpoints', 'kept', 'seconds', 'points/sec') + " ".join("%8s" % name for name in stage_names[1:]))
+	for stats in segment_stats:
+		print ("%-30s %11s %11s %9s %9.3f %12d " % (os.path.basename(stats['file']), "%s-%s" % tuple(stats['turns']), stats['trackpoints'], stats['kept'], stats['seconds'],
+			stats['trackpoints'] / stats['seconds'] if stats['seconds'] else 0) + " ".join("%8.3f" % stats['stages'].get(name, 0.0) for name in stage_names[1:]))
+	print ()
+	if profile_file:
+		print ("cProfile dump written to %s (view it with, ie, python -m pstats %s)" % (profile_file, profile_file))
+
 def main(argv=None):
-	global prefix, progress_window, progress_bar, progress, gui, mystdout, weborgui, pysimpleinstalled
+	global delta, memoize, out_archive, out_archive_file, fidelity, output_format, compact, decimals, user_rules, timing, profile_file, memtrace, prefix, strategy, seed, jobs, max_km, max_hours, max_trackpoints_per_file, balance, min_gap, max_gap, turn_radius, turn_share, distances, progress_window, progress_bar, progress, gui, mystdout, weborgui, pysimpleinstalled
 
-	arguments = docopt(__doc__)
+	arguments = docopt(__doc__, argv)
 	inputfilename = arguments["INPUTFILE"]
+
+	if arguments['generate-tcx']:
+		if not isInt(arguments['--trackpoints']) or int(arguments['--trackpoints']) < 2 or not isInt(arguments['--turn-every']) or int(arguments['--turn-every']) < 2:
+			print()
+			print ('*******ERROR**********')
+			print ("--trackpoints and --turn-every must be whole numbers, 2 or more")
+			print ('*******ERROR**********')
+			sys.exit(-1)
+		generator_seed = int(arguments['--seed']) if isInt(arguments['--seed']) else 0
+		route = generate_tcx(arguments['OUTPUTFILE'], int(arguments['--trackpoints']), int(arguments['--turn-every']), generator_seed)
+		print ("Made-up route with %s trackpoints and %s coursepoints written to %s" % (route['trackpoints'], route['coursepoints'], arguments['OUTPUTFILE']))
+		return 0
 	
 	saveprint = print
 	percent = 25
@@ -1050,6 +3257,7 @@ def main(argv=None):
 						[sg.Text('                                        REDUCE TRACKPOINTS',font=('default',18,'italic'),justification='center')],
 						[sg.Text('                  '),sg.Checkbox('Use Max Trackpoints                                                    OR                    ', enable_events=True, default=True,key='2_usemaxpoints'), sg.Checkbox('Use Percentage of Trackpoints               ', enable_events=True, key='2_usepercent')],
 						track_percent,
+						[sg.Text('                                                          Pruning strategy'), sg.Combo(list(prune_strategies), default_value='random', key='strategy'), sg.Text('(random, vw: Visvalingam-Whyatt, or spacing: by distance)')],
 						[sg.Text('')],
 						[sg.Text('File prefix for processed files'), sg.InputText('vp_',key='prefix', size=[15,1]), sg.Text('If more than one file, names will be, ie, vp_1_yourfilename.tcx, vp_2_yourfilename.tcx, ...') ],
 						[sg.Text('')],
@@ -1083,7 +3291,7 @@ def main(argv=None):
 		else:
 			main_window = sg.Window('VPrune', layout, text_justification='center', use_default_focus=False, background_color=window_bcolor)
 	
-	if (not isinstance(inputfilename, str) or len(inputfilename)==0) and pysimpleinstalled == True:
+	if (not isinstance(inputfilename, str) or len(inputfilename)==0) and pysimpleinstalled == True and not arguments['benchmark']:
 		gui = True
 	
 
@@ -1186,8 +3394,8 @@ def main(argv=None):
 					main_window.BringToFront()
 				continue
 
-			elif not inputfilename.lower().endswith('.tcx'):				
-					sg.Popup("VPrune - File not .tcx", "File must have .tcx extension; please try again", keep_on_top=True)
+			elif not inputfilename.lower().endswith(('.tcx', '.gpx')):				
+					sg.Popup("VPrune - File not .tcx", "File must have .tcx or .gpx extension; please try again", keep_on_top=True)
 					time.sleep(0.05)
 					if weborgui != 'web':
 						main_window.BringToFront()
@@ -1309,6 +3517,10 @@ def main(argv=None):
 				print('Assuming DEFAULT maximum Trackpoints in each output file: %i\n'%maxpoints)	
 				#sys.stderr.flush()
 
+			if values['strategy'] in prune_strategies:
+				strategy = values['strategy']
+			print('Trackpoint pruning strategy: %s \n' % strategy)
+
 			if values['prefix'] and len(values['prefix'])>0:
 				prefix = values['prefix']
 			print('Output file prefix will be %s \n' % prefix)
@@ -1356,10 +3568,30 @@ def main(argv=None):
 				sys.stderr.write('Assuming DEFAULT Maximum Turns/Coursepoints in each output file: %d\n' % maxturns)
 				#sys.stderr.flush()
 
-			if arguments['overlap_num'] and len(arguments['overlap_num'])>0 and isInt(arguments['overlap_num']) and int(round(float(arguments['overlap_num']))) > 0:
-				overlap_num = int(round(float(values['overlap_num'])))
+			if arguments['--overlap_num'] and len(arguments['--overlap_num'])>0 and isInt(arguments['--overlap_num']) and int(round(float(arguments['--overlap_num']))) > 0:
+				overlap_num = int(round(float(arguments['--overlap_num'])))
 				sys.stderr.write('Overlap split files by %d turns\n' % overlap_num)
 
+			if arguments['--max-km']:
+				max_km = number_option(arguments, '--max-km')
+				sys.stderr.write('Maximum distance in each output file: %g km \n' % max_km)
+			if arguments['--max-hours']:
+				max_hours = number_option(arguments, '--max-hours')
+				sys.stderr.write('Maximum time in each output file: %g hours \n' % max_hours)
+			if arguments['--max-trackpoints-per-file'] and isInt(arguments['--max-trackpoints-per-file']) and int(arguments['--max-trackpoints-per-file']) > 0:
+				max_trackpoints_per_file = int(arguments['--max-trackpoints-per-file'])
+				sys.stderr.write('Maximum original Trackpoints in each output file: %d \n' % max_trackpoints_per_file)
+			if arguments['--balance']:
+				balance_measures = {'turns': 'turns', 'trackpoints': 'points', 'bytes': 'bytes'}
+				if arguments['--balance'] not in balance_measures:
+					print()
+					print ('*******ERROR**********')
+					print ("unknown --balance '%s'; choose one of: %s" % (arguments['--balance'], ", ".join(balance_measures)))
+					print ('*******ERROR**********')
+					sys.exit(-1)
+				balance = balance_measures[arguments['--balance']]
+				sys.stderr.write('Balance split files by %s \n' % arguments['--balance'])
+
 
 			if arguments['--cleancourse']:
 				cleancourse=True
@@ -1383,6 +3615,17 @@ def main(argv=None):
 				cleannotes=True
 				sys.stderr.write('Will strip Notes from all CoursePoints\n')
 				#sys.stderr.flush()
+			if arguments['--rules']:
+				try:
+					user_rules = load_rules_file(arguments['--rules'])
+				except (OSError, ValueError, KeyError, TypeError, AttributeError, re.error, etree.XPathError) as e:
+					print()
+					print ('*******ERROR**********')
+					print ("could not load --rules file '%s': %s" % (arguments['--rules'], e))
+					print ('*******ERROR**********')
+					sys.exit(-1)
+				sys.stderr.write('Cleanup rules from %s: %s \n' % (arguments['--rules'], ", ".join(user_rules)))
+
 			if arguments['--trimnotes']:
 				trimnotes=True
 				cleannotes=False #must force this to false or there isn't much reason for --trimnotes
@@ -1394,32 +3637,148 @@ def main(argv=None):
 					sys.stderr.write('Will not trim Notes to 32 characters\n')
 					#sys.stderr.flush()
 
-			if arguments['--maxpoints'] and isInt(arguments['--maxpoints']):
-				maxpoints = int(arguments['--maxpoints'])
-				percent = 0
-				assert (maxpoints >= 0)
-				sys.stderr.write('Maximum Trackpoints in each output file = %d \n' % maxpoints)
-				#sys.stderr.flush()
-			elif arguments['--percent'] and isInt(arguments['--percent']):
-				percent = int(arguments['--percent'])				
-				maxpoints = 0
-				assert (percent >= 0 and percent <= 100)
-				sys.stderr.write('Percent of Trackpoints to retain = %d \n' % percent)
-				#sys.stderr.flush()
+			tiers = None
+			for option in ('--maxpoints', '--percent'):
+				if arguments[option] and ',' in arguments[option] and not tiers:
+					values = arguments[option].split(',')
+					if not all(isInt(value) and int(value) >= 0 for value in values) or (option == '--percent' and max(int(value) for value in values) > 100):
+						print()
+						print ('*******ERROR**********')
+						print ("%s '%s' should be a comma separated list of whole numbers" % (option, arguments[option]))
+						print ('*******ERROR**********')
+						sys.exit(-1)
+					tiers = [(int(value), 0) if option == '--maxpoints' else (0, int(value)) for value in values]
+					maxpoints, percent = tiers[0]
+					sys.stderr.write('A set of output files for each of %s %s \n' % (option, arguments[option]))
+			if not tiers:
+				if arguments['--maxpoints'] and isInt(arguments['--maxpoints']):
+					maxpoints = int(arguments['--maxpoints'])
+					percent = 0
+					assert (maxpoints >= 0)
+					sys.stderr.write('Maximum Trackpoints in each output file = %d \n' % maxpoints)
+					#sys.stderr.flush()
+				elif arguments['--percent'] and isInt(arguments['--percent']):
+					percent = int(arguments['--percent'])				
+					maxpoints = 0
+					assert (percent >= 0 and percent <= 100)
+					sys.stderr.write('Percent of Trackpoints to retain = %d \n' % percent)
+					#sys.stderr.flush()
+				else:
+					maxpoints = 500
+					sys.stderr.write('Assuming DEFAULT maximum Trackpoints in each output file: %i\n'%maxpoints)	
+					#sys.stderr.flush()
+
+			if arguments['--strategy'] in prune_strategies:
+				strategy = arguments['--strategy']
 			else:
-				maxpoints = 500
-				sys.stderr.write('Assuming DEFAULT maximum Trackpoints in each output file: %i\n'%maxpoints)	
-				#sys.stderr.flush()
+				print()
+				print ('*******ERROR**********')
+				print ("unknown --strategy '%s'; choose one of: %s" % (arguments['--strategy'], ", ".join(prune_strategies)))
+				print ('*******ERROR**********')
+				sys.exit(-1)
+			sys.stderr.write('Trackpoint pruning strategy: %s \n' % strategy)
+
+			if arguments['--seed'] and isInt(arguments['--seed']):
+				seed = int(arguments['--seed'])
+			sys.stderr.write('Random seed: %d \n' % seed)
+
+			if strategy == 'spacing':
+				if arguments['--min-gap']:
+					min_gap = number_option(arguments, '--min-gap', 0, True)
+				if arguments['--max-gap']:
+					max_gap = number_option(arguments, '--max-gap', 0)
+				if max_gap < min_gap:
+					print()
+					print ('*******ERROR**********')
+					print ("--max-gap (%s) must be at least as large as --min-gap (%s)" % (max_gap, min_gap))
+					print ('*******ERROR**********')
+					sys.exit(-1)
+				sys.stderr.write('Keep Trackpoints %g to %g meters apart \n' % (min_gap, max_gap))
+
+			if arguments['--turn-radius']:
+				turn_radius = number_option(arguments, '--turn-radius', 0, True)
+			if turn_radius > 0:
+				if arguments['--turn-share']:
+					turn_share = number_option(arguments, '--turn-share', 0, True, 100)
+				sys.stderr.write('Spend %g%% of Trackpoints within %g meters of turns \n' % (turn_share, turn_radius))
+
+			if arguments['--fidelity']:
+				fidelity = True
+				sys.stderr.write('Will report how far the removed Trackpoints are from the route \n')
+
+			if arguments['--distances'] in ('file', 'check', 'compute'):
+				distances = arguments['--distances']
+			else:
+				print()
+				print ('*******ERROR**********')
+				print ("unknown --distances '%s'; choose file, check or compute" % arguments['--distances'])
+				print ('*******ERROR**********')
+				sys.exit(-1)
+			sys.stderr.write('Trackpoint distances: %s \n' % distances)
 
 			if arguments['--prefix'] and len(arguments['--prefix'])>0:
 				prefix = arguments['--prefix']
 			sys.stderr.write('Output file prefix will be %s \n' % prefix)
+
+			if arguments['--compact']:
+				compact = True
+				if arguments['--decimals'] and isInt(arguments['--decimals']) and int(arguments['--decimals']) >= 0:
+					decimals = int(arguments['--decimals'])
+				sys.stderr.write('Compact output files, lat & long to %s decimal places \n' % decimals)
+
+			if arguments['--format'] in ('tcx', 'gpx', 'fit'):
+				output_format = arguments['--format']
+				sys.stderr.write('Output files will be %s files \n' % output_format.upper())
+			elif arguments['--format']:
+				print()
+				print ('*******ERROR**********')
+				print ("unknown --format '%s'; choose tcx, gpx or fit" % arguments['--format'])
+				print ('*******ERROR**********')
+				sys.exit(-1)
+
+			if arguments['--jobs'] and isInt(arguments['--jobs']):
+				jobs = int(arguments['--jobs'])
+
+			if arguments['--out-tar']:
+				out_archive_file = tar_stdout if arguments['--out-tar'] == '-' else open(arguments['--out-tar'], 'wb')
+				out_archive = tarfile.open(fileobj=out_archive_file, mode='w|')
+				sys.stderr.write('Output files go into the tar %s \n' % ('on stdout' if arguments['--out-tar'] == '-' else arguments['--out-tar']))
+
+			if arguments['--delta']:
+				if out_archive is not None or inputfilename == '-':
+					print()
+					print ('*******ERROR**********')
+					print ("--delta leaves unchanged output files where they are, so it needs an input file and the output files on disk (not --out-tar or stdin)")
+					print ('*******ERROR**********')
+					sys.exit(-1)
+				delta = True
+				sys.stderr.write('Will write only the output files whose part of the route changed since the last --delta run \n')
+
+			if arguments['--profile'] or arguments['--cprofile']:
+				if arguments['--cprofile']:
+					profile_file = arguments['--cprofile']
+				timing = True
+				sys.stderr.write('Profiling this run%s \n' % (', cProfile dump to ' + profile_file if profile_file else ''))
+
+			if arguments['--memtrace']:
+				memtrace = True
+				sys.stderr.write('Tracing memory use \n')
 			#sys.stderr.flush()
 
-			if not inputfilename.lower().endswith('.tcx') and not gui:			
+			if arguments['benchmark']:
+				sizes = [int(size) for size in arguments['--sizes'].split(',') if isInt(size) and int(size) >= 2]
+				if not sizes or not isInt(arguments['--threshold']):
+					print()
+					print ('*******ERROR**********')
+					print ("--sizes must be a comma separated list of route sizes, ie 10000,100000, and --threshold a percentage")
+					print ('*******ERROR**********')
+					sys.exit(-1)
+			elif inputfilename == '-':
+				sys.stderr.write('Reading the .tcx file from stdin \n')
+			elif not inputfilename.lower().endswith(('.tcx', '.gpx')) and not gui:			
 				print()
 				print ('*******ERROR**********')
-				print ("input file '%s' has no .tcx extension" % inputfilename)
+				print ("input file '%s' has no .tcx or .gpx extension" % inputfilename)
 				print ("Use 'vprune.py --help' for command line options")
 				print ('*******ERROR**********')
 
@@ -1476,17 +3835,40 @@ def main(argv=None):
 				progress_window.Finalize()
 				#if progress_debug:
 					#sg.Print(do_not_reroute_stdout=False)
-				tree = etree.parse(inputfilename)
+				run_start = time.perf_counter()
+				#Between runs in the GUI, only the stages whose options changed are run again
+				memoize = True
+				tree = read_route(inputfilename)
 				root = tree.getroot()	
+				if weborgui == 'web':
+					#The output files & a report go into a zip in memory, for the browser to download in one go
+					zip_buffer = BytesIO()
+					out_archive = zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED)
+					input_info = input_counts(inputfilename, root)
 
 				# start capturing all text output
 				old_stdout = sys.stdout
 				sys.stdout = mystdout = StringIO()
 
-				process_file_segments (tree, root, inputfilename, maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes)
+				process_courses (tree, inputfilename, maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes, overlap_num)
 
 				print ("PROCESSING COMPLETED")
-				print ("\n\nProcessed file(s) will start with", prefix," and are in the same directory as your original .tcx file \n" + os.path.dirname(inputfilename))
+				if out_archive is not None:
+					write_report(prefix + "report.json", input_info, run_parameters(maxturns, split, overlap_num, maxpoints, percent, None, cleancourse, cleannotes, trimnotes), time.perf_counter() - run_start)
+					out_archive.close()
+					out_archive = None
+					zipname = prefix + os.path.splitext(os.path.basename(inputfilename))[0] + ".zip"
+					try:
+						print ("\n\nAll the processed files are in one zip file (%s KB):\n%s" % (round(len(zip_buffer.getvalue()) / 1024), save_download(inputfilename, zipname, zip_buffer.getvalue())))
+					except OSError as e:
+						print ("\n*******ERROR**********\nCould not write the zip file: %s\n*******ERROR**********" % e)
+					try:
+						url = serve_download(zipname, zip_buffer.getvalue())
+						print ("If your browser is on this machine, you can also download it from:\n%s" % url)
+					except OSError as e:
+						print ("Could not offer the zip file for download on port %s: %s" % (download_port, e))
+				else:
+					print ("\n\nProcessed file(s) will start with", prefix," and are in the same directory as your original .tcx file \n" + os.path.dirname(inputfilename))
 				sys.stdout = old_stdout
 						
 				result_string = mystdout.getvalue()			
@@ -1502,10 +3884,56 @@ def main(argv=None):
 					main_window.BringToFront()
 				#sg.Popup("VPrune - Completed!", "File Processed!\nFile is in the same file as your original .tcx file \n" + os.path.dirname(inputfilename))			
 		else:
-			tree = etree.parse(inputfilename)
-			root = tree.getroot()	
+			if arguments['--dry-run']:
+				if not inputfilename.lower().endswith('.tcx'):
+					print()
+					print ('*******ERROR**********')
+					print ("--dry-run reads .tcx files only")
+					print ('*******ERROR**********')
+					sys.exit(-1)
+				dry_run(inputfilename, maxturns, split, maxpoints, percent, overlap_num, tiers)
+				break
 
-			process_file_segments (tree, root, inputfilename, maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes)
+			if arguments['benchmark']:
+				if run_benchmark(sizes, arguments['--baseline'], float(arguments['--threshold']), maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes, overlap_num):
+					sys.exit(1)
+				break
+
+			if arguments['bench-strategies']:
+				bench_strategies(inputfilename, maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes, overlap_num)
+				break
+
+			profiler = cProfile.Profile() if profile_file else None
+			if profiler:
+				profiler.enable()
+			if memtrace:
+				tracemalloc.start()
+				start_snapshot = tracemalloc.take_snapshot()
+			run_start = time.perf_counter()
+			with stage('parse'):
+				tree = read_route(inputfilename)
+			root = tree.getroot()	
+			if arguments['--report']:
+				input_info = input_counts(inputfilename, root)
+			if inputfilename == '-':
+				inputfilename = 'stdin.tcx' #so the output files are vp_1_stdin.tcx, ...
+
+			process_courses (tree, inputfilename, maxturns, split, maxpoints, percent, cleancourse, cleannotes, trimnotes, overlap_num, tiers)
+			if out_archive is not None:
+				out_archive.close()
+				out_archive_file.flush()
+				if out_archive_file is not tar_stdout:
+					out_archive_file.close()
+			if profiler:
+				profiler.disable()
+				profiler.dump_stats(profile_file)
+			if arguments['--report']:
+				write_report(arguments['--report'], input_info, run_parameters(maxturns, split, overlap_num, maxpoints, percent, tiers, cleancourse, cleannotes, trimnotes), time.perf_counter() - run_start)
+			if timing:
+				print_profile(time.perf_counter() - run_start)
+			if memtrace:
+				print_memtrace(start_snapshot)
+				tracemalloc.stop()
 			break
 	if gui:
 		main_window.Close()
@@ -1513,4 +3941,3 @@ def main(argv=None):
 
 if __name__ == "__main__":
 	sys.exit(main())
-sys.exit()